@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+import numpy as np
+
+
+def daily_series(rows, start, days):
+    # Spread (day, units, revenue) rollup rows over a dense array of `days`
+    # days beginning at `start`; days without sales stay at zero
+    units = np.zeros(days)
+    revenue = np.zeros(days)
+    if rows:
+        offsets = np.fromiter(((row.day - start).days for row in rows), dtype=np.int64, count=len(rows))
+        np.add.at(units, offsets, np.fromiter((row.units for row in rows), dtype=float, count=len(rows)))
+        np.add.at(revenue, offsets, np.fromiter((row.revenue for row in rows), dtype=float, count=len(rows)))
+    dates = [start + timedelta(days=i) for i in range(days)]
+    return dates, units, revenue
+
+
+def moving_average(values, window):
+    # Trailing mean over `window` days; the first days average what exists so
+    # far rather than padding with zeros
+    totals = np.cumsum(values)
+    totals[window:] = totals[window:] - totals[:-window]
+    return totals / np.minimum(np.arange(1, len(values) + 1), window)
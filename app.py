@@ -1,144 +1,1235 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
-from flask_sqlalchemy import SQLAlchemy
+from flask import Blueprint, Flask, Response, render_template, request, redirect, url_for, flash, jsonify, session, \
+    make_response, abort, current_app, g, send_from_directory, stream_with_context
+from sqlalchemy import event, func, and_, or_, text, column, delete, insert, literal, select, union_all, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import contains_eager, joinedload
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from werkzeug.local import LocalProxy
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from collections import defaultdict
+from datetime import datetime, timedelta
+from functools import wraps
+import base64
+import csv
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import logging
+import math
+import mimetypes
 import os
+import random
+import re
+import tempfile
+import click
+from analytics import daily_series, moving_average
+from assets import AssetManifest, build_assets
+from cache import TTLCache
+from config import load_settings
+from events import load_broker
+from metrics import init_metrics, register_caches
+from models import db, User, Product, Order, OrderItem, Review, Cart, ProductRating, SalesRollup, CatalogVersion, \
+    CoPurchase, Recommendation, ArchivedOrder, ArchivedOrderItem, product_search
+from prefork import serve
+from query_stats import init_query_stats, query_budget
+from recommendations import co_purchase_counts, top_neighbours
+from suggest import SuggestIndex
+from thumbnails import ThumbnailPool, make_thumbnails, save_original, thumbnail_name, thumbnails_ready
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your-secret-key-here'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///farmers_market.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Every route, template helper and CLI command below is registered on this
+# blueprint; create_app() builds the Flask app around it
+bp = Blueprint('market', __name__, cli_group=None)
 
-db = SQLAlchemy(app)
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
-
-# Models - Define all models first without relationships that reference undefined classes
-class User(UserMixin, db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80), unique=True, nullable=False)
-    email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(120), nullable=False)
-    user_type = db.Column(db.String(20), nullable=False)  # 'farmer' or 'customer'
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-
-class Product(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    description = db.Column(db.Text)
-    price = db.Column(db.Float, nullable=False)
-    quantity = db.Column(db.Integer, nullable=False)
-    category = db.Column(db.String(50))
-    image_url = db.Column(db.String(200))
-    farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-
-class Order(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    total_amount = db.Column(db.Float, nullable=False)
-    status = db.Column(db.String(20), default='pending')  # pending, accepted, shipped, delivered, cancelled
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    
-    # Relationships
-    order_items = db.relationship('OrderItem', backref='order', lazy=True)
-
-class OrderItem(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
-    quantity = db.Column(db.Integer, nullable=False)
-    price = db.Column(db.Float, nullable=False)
-    farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # Add farmer_id to track who needs to fulfill
-
-class Review(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
-    customer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    rating = db.Column(db.Integer, nullable=False)
-    comment = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-
-class Cart(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
-    quantity = db.Column(db.Integer, nullable=False)
-
-# Now add relationships after all classes are defined
-# User relationships
-User.products = db.relationship('Product', backref='farmer', lazy=True, foreign_keys='Product.farmer_id')
-User.orders = db.relationship('Order', backref='customer', lazy=True, foreign_keys='Order.customer_id')
-User.written_reviews = db.relationship('Review', backref='author', lazy=True, foreign_keys='Review.customer_id')
-User.received_reviews = db.relationship('Review', backref='farmer_received', lazy=True, foreign_keys='Review.farmer_id')
-User.cart_items = db.relationship('Cart', backref='cart_owner', lazy=True, foreign_keys='Cart.customer_id')
-
-# Product relationships
-Product.order_items = db.relationship('OrderItem', backref='product', lazy=True)
-Product.reviews = db.relationship('Review', backref='product', lazy=True, foreign_keys='Review.product_id')  # Fixed this line
-Product.in_carts = db.relationship('Cart', backref='cart_product', lazy=True, foreign_keys='Cart.product_id')
-
-# Order relationships
-Order.order_items = db.relationship('OrderItem', backref='order', lazy=True)
-
-# Cart relationships
-Cart.product = db.relationship('Product', backref='product_carts', lazy=True, foreign_keys='Cart.product_id')
-
-# Review relationships - Add these missing relationships
-Review.product_rel = db.relationship('Product', backref='reviewed_products', lazy=True, foreign_keys='Review.product_id')
-Review.customer_rel = db.relationship('User', backref='reviewing_customers', lazy=True, foreign_keys='Review.customer_id')
-Review.farmer_rel = db.relationship('User', backref='reviewed_farmers', lazy=True, foreign_keys='Review.farmer_id')
-oduct = db.relationship('Product', backref='product_carts', lazy=True, foreign_keys='Cart.product_id')
+login_manager.login_view = 'market.login'
+
+# Per-app services, created by create_app() and looked up through the current
+# app so module-level code can keep using them by name
+def app_service(name):
+    return LocalProxy(lambda: current_app.extensions['market'][name])
+
+catalog_cache = app_service('catalog_cache')
+user_cache = app_service('user_cache')
+asset_manifest = app_service('asset_manifest')
+thumbnail_pool = app_service('thumbnail_pool')
+broker = app_service('broker')
+suggest_index = app_service('suggest_index')
+metrics_registry = LocalProxy(lambda: current_app.extensions['metrics'])
+
+def apply_sqlite_pragmas(engine, pragmas):
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+def source_stamp(app):
+    # Newest modification time of the app's code and templates. A deploy
+    # changes it, so catalog ETags from the old build stop matching.
+    folders = [(app.root_path, '.py'), (os.path.join(app.root_path, app.template_folder), '.html')]
+    paths = [os.path.join(folder, name) for folder, suffix in folders
+             for name in os.listdir(folder) if name.endswith(suffix)]
+    return str(max(os.stat(path).st_mtime_ns for path in paths))
+
+def create_app(settings=None):
+    app = Flask(__name__)
+    app.config.from_mapping(load_settings())
+    if settings:
+        app.config.update(settings)
+    if not app.config['ASSET_DIR']:
+        app.config['ASSET_DIR'] = os.path.join(app.static_folder, 'dist')
+    if not app.config['MEDIA_FOLDER']:
+        app.config['MEDIA_FOLDER'] = os.path.join(app.instance_path, 'media')
+    if not app.config['BUILD_ID']:
+        app.config['BUILD_ID'] = source_stamp(app)
+    
+    db.init_app(app)
+    if app.config['SQLITE_PRAGMAS']:
+        with app.app_context():
+            apply_sqlite_pragmas(db.engine, app.config['SQLITE_PRAGMAS'])
+    
+    login_manager.init_app(app)
+    init_query_stats(app)
+    app.extensions['market'] = {
+        'catalog_cache': TTLCache(maxsize=64, ttl=app.config['CATALOG_CACHE_TTL']),
+        'user_cache': TTLCache(maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL']),
+        'asset_manifest': AssetManifest(os.path.join(app.config['ASSET_DIR'], 'manifest.json')),
+        'thumbnail_pool': ThumbnailPool(app.config['MEDIA_FOLDER'], app.config['THUMBNAIL_WORKERS']),
+        'broker': load_broker(app.config['EVENT_BROKER']),
+        'suggest_index': SuggestIndex(app.config['SUGGEST_REFRESH']),
+    }
+    register_caches(init_metrics(app), {name: app.extensions['market'][name]
+                                        for name in ('catalog_cache', 'user_cache')})
+    app.register_blueprint(bp)
+    return app
+
+def reset_after_fork(app):
+    # Pooled connections were opened by the parent process; forget them
+    # without closing so the parent's handles are left alone
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+@bp.cli.command('serve')
+@click.option('--bind', default='127.0.0.1:8000', show_default=True, help='host:port to listen on')
+@click.option('--workers', default=os.cpu_count() or 2, show_default=True, help='number of worker processes')
+@click.option('--preload/--no-preload', default=True, show_default=True,
+              help='build the app once before forking instead of in every worker')
+def serve_command(bind, workers, preload):
+    """Serve the app from several preforked worker processes."""
+    if not logging.getLogger().handlers:
+        # Worker lifecycle at INFO, everything else (e.g. per-request query
+        # stats) only from WARNING up
+        logging.basicConfig(level=logging.WARNING, format='[%(asctime)s] [%(process)d] %(message)s')
+        logging.getLogger('prefork').setLevel(logging.INFO)
+    # Workers report metrics through files in one shared directory, so any
+    # of them can answer /metrics for the whole server
+    metrics_dir = current_app.config['METRICS_DIR'] or tempfile.mkdtemp(prefix='market-metrics-')
+    os.environ['METRICS_DIR'] = current_app.config['METRICS_DIR'] = metrics_dir
+    metrics_registry.directory = metrics_dir
+    metrics_registry.clear_directory()
+    # The cart upserts need the unique cart index, which create_all doesn't
+    # add to a database from before it; build it before any worker starts
+    db.create_all()
+    created = create_missing_indexes()
+    if created:
+        click.echo(f'Created {len(created)} missing indexes: ' + ', '.join(created), err=True)
+    load_app = current_app._get_current_object if preload else create_app
+    serve(load_app, bind=bind, workers=workers, preload=preload, after_fork=reset_after_fork)
+
+# Signed in users. Requests only read a handful of fields from current_user,
+# so those are cached per process instead of loading the user row every time.
+# Anything that writes to a user must call forget_user().
+class CachedUser(UserMixin):
+    def __init__(self, id, username, user_type, email):
+        self.id = id
+        self.username = username
+        self.user_type = user_type
+        self.email = email
+
+def load_cached_user(user_id):
+    row = db.session.query(User.id, User.username, User.user_type, User.email).\
+        filter(User.id == user_id).\
+        first()
+    return CachedUser(*row) if row else None
+
+def forget_user(user_id):
+    user_cache.invalidate(user_id)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    return user_cache.get_or_load(user_id, lambda: load_cached_user(user_id))
+
+# Rating summaries
+def record_rating(product_id, rating):
+    # Bump the stored totals in SQL so two reviews landing at once can't lose a count
+    star_column = getattr(ProductRating, f'stars_{rating}')
+    updated = ProductRating.query.filter_by(product_id=product_id).update({
+        ProductRating.rating_count: ProductRating.rating_count + 1,
+        ProductRating.rating_sum: ProductRating.rating_sum + rating,
+        star_column: star_column + 1,
+    }, synchronize_session=False)
+    if not updated:
+        summary = ProductRating(product_id=product_id, rating_count=1, rating_sum=rating)
+        setattr(summary, f'stars_{rating}', 1)
+        db.session.add(summary)
+
+def rebuild_ratings():
+    ProductRating.query.delete()
+    rows = db.session.query(Review.product_id, Review.rating, func.count(Review.id)).\
+        group_by(Review.product_id, Review.rating).\
+        all()
+
+    summaries = {}
+    for product_id, rating, count in rows:
+        if rating not in range(1, 6):
+            continue
+        summary = summaries.setdefault(product_id, {
+            'product_id': product_id, 'rating_count': 0, 'rating_sum': 0,
+            'stars_1': 0, 'stars_2': 0, 'stars_3': 0, 'stars_4': 0, 'stars_5': 0,
+        })
+        summary['rating_count'] += count
+        summary['rating_sum'] += rating * count
+        summary[f'stars_{rating}'] += count
+
+    if summaries:
+        db.session.execute(ProductRating.__table__.insert(), list(summaries.values()))
+    return len(summaries)
+
+# Catalog reads that rarely change between product edits. Plain dicts are
+# cached rather than ORM objects so they can be shared across sessions.
+# Entries are keyed on the catalog version: each worker has its own cache, and
+# one that missed another worker's write must not render stale data under
+# the ETag of the new version.
+def catalog_cache_key(name):
+    # catalog_etag() has already read the version for the pages it wraps
+    version = g.get('catalog_version')
+    if version is None:
+        version = catalog_version()
+    return name, version
+
+def catalog_categories():
+    def load():
+        categories = db.session.query(Product.category).distinct().all()
+        return [cat[0] for cat in categories if cat[0]]
+    return catalog_cache.get_or_load(catalog_cache_key('categories'), load)
+
+def featured_products():
+    def load():
+        products = Product.query.filter(Product.quantity > 0).limit(8).all()
+        return [{
+            'id': product.id,
+            'name': product.name,
+            'description': product.description or '',
+            'price': product.price,
+            'quantity': product.quantity,
+        } for product in products]
+    return catalog_cache.get_or_load(catalog_cache_key('featured'), load)
+
+# Conditional GET for catalog pages
+def catalog_version():
+    return db.session.query(CatalogVersion.version).filter_by(id=1).scalar() or 0
+
+def bump_catalog_version():
+    # Call inside the transaction that changes the catalog
+    updated = CatalogVersion.query.filter_by(id=1).\
+        update({CatalogVersion.version: CatalogVersion.version + 1}, synchronize_session=False)
+    if not updated:
+        db.session.add(CatalogVersion(id=1, version=1))
+
+def catalog_etag(view):
+    # Answer If-None-Match with a 304 before the view runs any ORM queries or
+    # renders a template. The tag covers the URL, the logged in user (pages
+    # differ per user), the cart badge, the catalog version, and the build:
+    # BUILD_ID for code and templates, the asset manifest for hashed asset
+    # URLs, so pages cached before a deploy are sent again.
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if '_flashes' in session:
+            # Pending flash messages have to be rendered
+            return view(*args, **kwargs)
+        
+        g.catalog_version = catalog_version()
+        stamp = f'{request.full_path}|{session.get("_user_id", "")}|{session.get("cart_units", "")}|' \
+                f'{g.catalog_version}|{current_app.config["BUILD_ID"]}|{asset_manifest.version}'
+        etag = hashlib.sha1(stamp.encode()).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+        return response
+    return wrapper
+
+# Bulk CSV product import
+PRODUCT_CATEGORIES = ['Vegetables', 'Fruits', 'Grains', 'Dairy', 'Meat', 'Herbs', 'Organic', 'Other']
+
+def parse_product_row(row):
+    errors = []
+    name = (row.get('name') or '').strip()
+    description = (row.get('description') or '').strip()
+    category = (row.get('category') or '').strip()
+    
+    if not name:
+        errors.append('name is required')
+    elif len(name) > 100:
+        errors.append('name is longer than 100 characters')
+    
+    try:
+        price = float(row.get('price') or '')
+        if not math.isfinite(price) or price < 0:
+            raise ValueError
+    except ValueError:
+        price = None
+        errors.append('price must be a number of 0 or more')
+    
+    try:
+        quantity = int(row.get('quantity') or '')
+        if quantity < 0:
+            raise ValueError
+    except ValueError:
+        quantity = None
+        errors.append('quantity must be a whole number of 0 or more')
+    
+    if category and category not in PRODUCT_CATEGORIES:
+        errors.append(f'category must be one of {", ".join(PRODUCT_CATEGORIES)}')
+    
+    product = {'name': name, 'description': description, 'price': price,
+               'quantity': quantity, 'category': category or 'Other'}
+    return product, errors
+
+def insert_product_batch(rows):
+    # One executemany for the products, one for their search rows, one commit.
+    # The insert holds SQLite's write lock until commit, so the batch's rowids
+    # are the last len(rows) ids and can be read back without RETURNING.
+    db.session.execute(Product.__table__.insert(), rows)
+    last_id = db.session.query(func.max(Product.id)).scalar()
+    product_ids = range(last_id - len(rows) + 1, last_id + 1)
+    db.session.execute(product_search.insert(), [{
+        'rowid': product_id,
+        'name': row['name'],
+        'description': row['description'],
+        'category': row['category'],
+    } for product_id, row in zip(product_ids, rows)])
+    bump_catalog_version()
+    version = catalog_version()
+    db.session.commit()
+    catalog_cache.invalidate()
+    for product_id, row in zip(product_ids, rows):
+        suggest_index.add(product_id, row['name'], row['category'], row['quantity'])
+    suggest_index.advance(version)
+    return len(rows)
+
+def import_products_csv(stream, farmer_id):
+    # Reads the file row by row, so memory stays bounded by the batch size and
+    # the number of errors reported, not by the size of the upload
+    batch_size = current_app.config['IMPORT_BATCH_SIZE']
+    result = {'imported': 0, 'failed': 0, 'errors': [], 'stopped': None}
+    
+    reader = csv.DictReader(stream)
+    missing = {'name', 'price', 'quantity'} - set(reader.fieldnames or [])
+    if missing:
+        raise ValueError(f'The header row is missing: {", ".join(sorted(missing))}')
+    
+    def reject(errors):
+        result['failed'] += 1
+        if len(result['errors']) < current_app.config['IMPORT_MAX_REPORTED_ERRORS']:
+            result['errors'].append({'line': reader.line_num, 'errors': errors})
+    
+    batch = []
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            break
+        except csv.Error as e:
+            # A row the csv module can't parse, e.g. a field over its size
+            # limit; the reader carries on from the next line
+            reject([f'could not read the row: {e}'])
+            continue
+        except UnicodeDecodeError as e:
+            # Bytes that aren't UTF-8. Batches already committed stay, so
+            # keep the rows read so far too and say where it stopped. The
+            # file is decoded in chunks, so the bad bytes can be a few lines on.
+            result['stopped'] = f'Stopped after line {reader.line_num}: the file has bytes that are not valid ' \
+                                f'UTF-8 ({e.reason}) soon after it. Rows from there on were not imported.'
+            break
+        
+        product, errors = parse_product_row(row)
+        if errors:
+            reject(errors)
+            continue
+        
+        product['farmer_id'] = farmer_id
+        batch.append(product)
+        if len(batch) >= batch_size:
+            result['imported'] += insert_product_batch(batch)
+            batch = []
+    
+    if batch:
+        result['imported'] += insert_product_batch(batch)
+    return result
+
+# Sales rollups
+def apply_to_rollups(order_day, items, sign=1):
+    # items are (farmer_id, product_id, quantity, price); sign=-1 takes a
+    # cancelled order back out. Runs in the caller's transaction.
+    if not items:
+        return
+    statement = sqlite_insert(SalesRollup)
+    statement = statement.on_conflict_do_update(
+        index_elements=['farmer_id', 'product_id', 'day'],
+        set_={
+            'units': SalesRollup.units + statement.excluded.units,
+            'revenue': SalesRollup.revenue + statement.excluded.revenue,
+            'order_count': SalesRollup.order_count + statement.excluded.order_count,
+        }
+    )
+    db.session.execute(statement, [{
+        'farmer_id': farmer_id,
+        'product_id': product_id,
+        'day': order_day,
+        'units': sign * quantity,
+        'revenue': sign * quantity * price,
+        'order_count': sign,
+    } for farmer_id, product_id, quantity, price in items])
+
+def rebuild_sales_rollups():
+    SalesRollup.query.delete()
+    # Archived orders still count towards sales
+    sold = union_all(*(
+        select(items.farmer_id, items.product_id, items.order_id, items.quantity, items.price,
+               func.date(orders.created_at).label('day')).
+        join(orders, items.order_id == orders.id).
+        where(orders.status != 'cancelled')
+        for orders, items in ((Order, OrderItem), (ArchivedOrder, ArchivedOrderItem))
+    )).subquery()
+    rows = db.session.query(
+        sold.c.farmer_id, sold.c.product_id, sold.c.day,
+        func.sum(sold.c.quantity), func.sum(sold.c.quantity * sold.c.price),
+        func.count(func.distinct(sold.c.order_id))
+    ).group_by(sold.c.farmer_id, sold.c.product_id, sold.c.day).\
+        all()
+    if rows:
+        db.session.execute(insert(SalesRollup), [{
+            'farmer_id': farmer_id,
+            'product_id': product_id,
+            'day': datetime.strptime(order_day, '%Y-%m-%d').date(),
+            'units': units,
+            'revenue': revenue,
+            'order_count': order_count,
+        } for farmer_id, product_id, order_day, units, revenue, order_count in rows])
+    return len(rows)
+
+def farmer_sales(farmer_id, days, window):
+    end = datetime.utcnow().date()
+    start = end - timedelta(days=days - 1)
+    
+    rows = db.session.query(
+        SalesRollup.day,
+        func.sum(SalesRollup.units).label('units'),
+        func.sum(SalesRollup.revenue).label('revenue')
+    ).filter(SalesRollup.farmer_id == farmer_id, SalesRollup.day >= start).\
+        group_by(SalesRollup.day).\
+        all()
+    dates, units, revenue = daily_series(rows, start, days)
+    
+    products = db.session.query(
+        Product.id, Product.name,
+        func.sum(SalesRollup.units), func.sum(SalesRollup.revenue), func.sum(SalesRollup.order_count)
+    ).join(Product, SalesRollup.product_id == Product.id).\
+        filter(SalesRollup.farmer_id == farmer_id, SalesRollup.day >= start).\
+        group_by(Product.id, Product.name).\
+        having(func.sum(SalesRollup.order_count) > 0).\
+        order_by(func.sum(SalesRollup.revenue).desc()).\
+        all()
+    
+    return {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'window': window,
+        'total_units': int(units.sum()),
+        'total_revenue': round(float(revenue.sum()), 2),
+        'daily': [{
+            'day': day.isoformat(),
+            'units': int(day_units),
+            'revenue': round(float(day_revenue), 2),
+            'revenue_avg': round(float(day_avg), 2),
+            'units_avg': round(float(day_units_avg), 2),
+        } for day, day_units, day_revenue, day_avg, day_units_avg in zip(
+            dates, units, revenue, moving_average(revenue, window), moving_average(units, window))],
+        'products': [{
+            'id': product_id,
+            'name': name,
+            'units': product_units,
+            'revenue': round(product_revenue, 2),
+            'orders': order_count,
+        } for product_id, name, product_units, product_revenue, order_count in products],
+    }
+
+# Order status changes
+ORDER_STATUSES = ['pending', 'accepted', 'shipped', 'delivered', 'cancelled']
+
+def set_order_statuses(orders, new_status):
+    # One UPDATE for every order, in the caller's transaction. Cancelling takes
+    # an order out of the sales rollups; reinstating it puts it back.
+    toggled = {order.id: order.created_at.date() for order in orders
+               if (order.status == 'cancelled') != (new_status == 'cancelled')}
+    if toggled:
+        items_by_day = defaultdict(list)
+        items = db.session.query(OrderItem.order_id, OrderItem.farmer_id, OrderItem.product_id,
+                                 OrderItem.quantity, OrderItem.price).\
+            filter(OrderItem.order_id.in_(toggled)).\
+            all()
+        for order_id, *item in items:
+            items_by_day[toggled[order_id]].append(item)
+        for order_day, day_items in items_by_day.items():
+            apply_to_rollups(order_day, day_items, sign=-1 if new_status == 'cancelled' else 1)
+    
+    now = datetime.utcnow()
+    db.session.execute(
+        update(Order).
+        where(Order.id.in_([order.id for order in orders])).
+        values(status=new_status, updated_at=now).
+        execution_options(synchronize_session='evaluate')
+    )
+    return now
+
+# Frequently bought together. CoPurchase holds the sparse product x product
+# co-occurrence counts and Recommendation the top RECOMMENDATION_DEPTH of
+# them per product; checkout updates both for the products it sold.
+RECOMMENDATION_DEPTH = 8
+RECOMMENDATIONS_SHOWN = 4
+RECOMMENDATION_BATCH = 10000
+
+def record_co_purchases(product_ids):
+    product_ids = sorted(set(product_ids))
+    if len(product_ids) < 2:
+        return
+    statement = sqlite_insert(CoPurchase).on_conflict_do_update(
+        index_elements=['product_id', 'other_id'],
+        set_={'order_count': CoPurchase.order_count + 1}
+    )
+    db.session.execute(statement, [{'product_id': product_id, 'other_id': other_id, 'order_count': 1}
+                                   for product_id in product_ids for other_id in product_ids
+                                   if product_id != other_id])
+    refresh_recommendations(product_ids)
+
+def refresh_recommendations(product_ids):
+    # Re-rank just these products in SQL, with the same tie-break as
+    # top_neighbours() so a full rebuild gives the same table
+    ranked = db.session.query(
+        CoPurchase.product_id,
+        func.row_number().over(partition_by=CoPurchase.product_id,
+                               order_by=(CoPurchase.order_count.desc(), CoPurchase.other_id)).label('rank'),
+        CoPurchase.other_id, CoPurchase.order_count
+    ).filter(CoPurchase.product_id.in_(product_ids)).\
+        subquery()
+    db.session.execute(delete(Recommendation).where(Recommendation.product_id.in_(product_ids)))
+    db.session.execute(insert(Recommendation).from_select(
+        ['product_id', 'rank', 'recommended_id', 'order_count'],
+        select(ranked).where(ranked.c.rank <= RECOMMENDATION_DEPTH)
+    ))
+
+def rebuild_recommendations():
+    # Count co-purchases over every order, archived ones included, with
+    # sparse matrix products instead of a self-join
+    items = db.session.execute(union_all(
+        select(OrderItem.order_id, OrderItem.product_id),
+        select(ArchivedOrderItem.order_id, ArchivedOrderItem.product_id),
+    )).all()
+    product_ids, other_ids, counts = co_purchase_counts([order_id for order_id, _ in items],
+                                                        [product_id for _, product_id in items])
+    
+    CoPurchase.query.delete()
+    Recommendation.query.delete()
+    rows = zip(product_ids.tolist(), other_ids.tolist(), counts.tolist())
+    while batch := list(itertools.islice(rows, RECOMMENDATION_BATCH)):
+        db.session.execute(insert(CoPurchase), [{'product_id': product_id, 'other_id': other_id,
+                                                 'order_count': count} for product_id, other_id, count in batch])
+    top = top_neighbours(product_ids, other_ids, counts, RECOMMENDATION_DEPTH)
+    rows = zip(*(column.tolist() for column in top))
+    while batch := list(itertools.islice(rows, RECOMMENDATION_BATCH)):
+        db.session.execute(insert(Recommendation), [{'product_id': product_id, 'rank': rank,
+                                                     'recommended_id': other_id, 'order_count': count}
+                                                    for product_id, rank, other_id, count in batch])
+    return len(set(top[0].tolist()))
+
+def recommended_products(product_id):
+    return Product.query.join(Recommendation, Recommendation.recommended_id == Product.id).\
+        filter(Recommendation.product_id == product_id, Product.quantity > 0).\
+        order_by(Recommendation.rank).\
+        limit(RECOMMENDATIONS_SHOWN)
+
+@bp.cli.command('rebuild-recommendations')
+def rebuild_recommendations_command():
+    """Rebuild the frequently-bought-together tables from the order history."""
+    db.create_all()
+    count = rebuild_recommendations()
+    bump_catalog_version()
+    db.session.commit()
+    click.echo(f'Rebuilt recommendations for {count} products')
+
+# Order archival. Delivered and cancelled orders that haven't changed for a
+# while move to the archive tables with their items, so the live order pages
+# only ever read recent orders. The archive is read by order_history().
+ARCHIVED_STATUSES = ('delivered', 'cancelled')
+ORDER_COLUMNS = ('id', 'customer_id', 'total_amount', 'status', 'created_at', 'updated_at')
+ORDER_ITEM_COLUMNS = ('id', 'order_id', 'product_id', 'quantity', 'price', 'farmer_id')
+
+def archivable_orders(cutoff):
+    # The newest order and the order holding the newest item always stay live:
+    # SQLite hands out max(id) + 1, so archiving them would let the next
+    # checkout reuse an id that is already in the archive
+    newest_order = db.session.query(func.max(Order.id)).scalar_subquery()
+    newest_item_order = db.session.query(OrderItem.order_id).\
+        filter(OrderItem.id == db.session.query(func.max(OrderItem.id)).scalar_subquery()).\
+        scalar_subquery()
+    return db.session.query(Order.id).\
+        filter(Order.status.in_(ARCHIVED_STATUSES), Order.updated_at < cutoff,
+               Order.id != func.coalesce(newest_order, 0), Order.id != func.coalesce(newest_item_order, 0))
+
+def archive_orders(older_than_days, batch_size):
+    # One transaction per batch so checkouts never wait long on the archiver.
+    # Returns how many orders and items were moved.
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    moved_orders = moved_items = 0
+    while True:
+        candidates = [order_id for (order_id,) in archivable_orders(cutoff).limit(batch_size)]
+        # End the read so the batch below starts with its write and sees the
+        # latest data; an order whose status changed since is left alone
+        db.session.commit()
+        if not candidates:
+            break
+        
+        db.session.execute(insert(ArchivedOrder).from_select(
+            ORDER_COLUMNS + ('archived_at',),
+            select(*(getattr(Order, name) for name in ORDER_COLUMNS), literal(datetime.utcnow())).
+            where(Order.id.in_(candidates), Order.status.in_(ARCHIVED_STATUSES), Order.updated_at < cutoff)
+        ))
+        order_ids = [order_id for (order_id,) in db.session.query(ArchivedOrder.id).
+                     filter(ArchivedOrder.id.in_(candidates))]
+        moved_items += db.session.execute(insert(ArchivedOrderItem).from_select(
+            ORDER_ITEM_COLUMNS,
+            select(*(getattr(OrderItem, name) for name in ORDER_ITEM_COLUMNS)).
+            where(OrderItem.order_id.in_(order_ids))
+        )).rowcount
+        db.session.execute(delete(OrderItem).where(OrderItem.order_id.in_(order_ids)))
+        db.session.execute(delete(Order).where(Order.id.in_(order_ids)))
+        db.session.commit()
+        moved_orders += len(order_ids)
+    return moved_orders, moved_items
+
+@bp.cli.command('archive-orders')
+@click.option('--days', type=int, help='Archive orders unchanged for this many days. '
+                                       '[default: ORDER_ARCHIVE_DAYS]')
+@click.option('--batch-size', type=int, help='Orders moved per transaction. [default: ORDER_ARCHIVE_BATCH]')
+def archive_orders_command(days, batch_size):
+    """Move old delivered and cancelled orders to the archive tables."""
+    db.create_all()
+    orders, items = archive_orders(days if days is not None else current_app.config['ORDER_ARCHIVE_DAYS'],
+                                   batch_size or current_app.config['ORDER_ARCHIVE_BATCH'])
+    click.echo(f'Archived {orders} orders with {items} items')
+
+@bp.cli.command('rebuild-sales-rollups')
+def rebuild_sales_rollups_command():
+    """Rebuild the daily sales rollups from the order history."""
+    db.create_all()
+    count = rebuild_sales_rollups()
+    db.session.commit()
+    click.echo(f'Rebuilt {count} daily sales rows')
+
+# Order events, pushed to each user's /events stream
+def order_events(event_name, orders):
+    # Build the messages before commit, while the orders are still loaded, and
+    # hand them to publish_events() once the commit has succeeded so
+    # subscribers never see a change that was rolled back
+    farmer_ids = defaultdict(set)
+    rows = db.session.query(OrderItem.order_id, OrderItem.farmer_id).\
+        filter(OrderItem.order_id.in_([order.id for order in orders])).\
+        distinct()
+    for order_id, farmer_id in rows:
+        farmer_ids[order_id].add(farmer_id)
+    
+    messages = []
+    for order in orders:
+        data = {
+            'order_id': order.id,
+            'status': order.status,
+            'total_amount': order.total_amount,
+            'customer': order.customer.username,
+            'created_at': order.created_at.strftime('%Y-%m-%d %H:%M'),
+            'updated_at': order.updated_at.strftime('%Y-%m-%d %H:%M'),
+        }
+        for user_id in {order.customer_id} | farmer_ids[order.id]:
+            messages.append((f'user:{user_id}', event_name, data))
+    return messages
+
+def publish_events(messages):
+    for channel, event_name, data in messages:
+        broker.publish(channel, event_name, data)
+
+# Search index
+def index_products(products):
+    # Replace the index rows for these products; call after a flush so ids exist
+    db.session.execute(product_search.delete().where(
+        product_search.c.rowid.in_([product.id for product in products])))
+    db.session.execute(product_search.insert(), [{
+        'rowid': product.id,
+        'name': product.name,
+        'description': product.description or '',
+        'category': product.category or '',
+    } for product in products])
+
+def unindex_product(product_id):
+    db.session.execute(product_search.delete().where(product_search.c.rowid == product_id))
+
+def rebuild_search_index():
+    db.session.execute(product_search.delete())
+    db.session.execute(text(
+        "INSERT INTO product_search (rowid, name, description, category) "
+        "SELECT id, name, coalesce(description, ''), coalesce(category, '') FROM product"
+    ))
+    return db.session.query(func.count(Product.id)).scalar()
+
+def search_expression(search):
+    # Quote every word so user input can't inject FTS5 syntax; the last word
+    # is a prefix match so partially typed terms still hit.
+    terms = re.findall(r'\w+', search)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+# bm25 weights for name, description and category; lower scores rank higher
+search_rank = func.bm25(column('product_search'), 10.0, 1.0, 5.0)
+
+# Search box suggestions, answered from memory. Product writes in this
+# process update the index directly, then advance its version to the one they
+# committed (read before commit, while the write lock keeps other writers
+# out), so they don't cause a reload. Anything else (other workers, stock sold
+# at checkout, new reviews) is picked up by a rebuild once the catalog version
+# has moved, which is checked at most every SUGGEST_REFRESH seconds.
+def suggestion_query():
+    return db.session.query(Product.id, Product.name, Product.category, Product.quantity,
+                            ProductRating.rating_sum, ProductRating.rating_count).\
+        outerjoin(ProductRating, ProductRating.product_id == Product.id).\
+        filter(Product.quantity > 0)
+
+def load_suggestions():
+    version = catalog_version()
+    if version == suggest_index.version:
+        return
+    rows = ((product_id, name, category, quantity, round(rating_sum / rating_count, 1) if rating_count else 0)
+            for product_id, name, category, quantity, rating_sum, rating_count in suggestion_query())
+    suggest_index.load(rows, version)
+
+def refresh_suggestions():
+    # The first load runs in the request, as there is nothing to answer from
+    # yet. Later checks run on a background thread and requests keep using
+    # the current index until the new one is swapped in.
+    suggest_index.mark_checked()
+    if not suggest_index.loaded:
+        load_suggestions()
+        return
+    app = current_app._get_current_object()
+    
+    def reload():
+        with app.app_context():
+            load_suggestions()
+    
+    suggest_index.reload_in_background(reload)
+
+@bp.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Rebuild the full-text product search index from the product table."""
+    db.create_all()
+    count = rebuild_search_index()
+    bump_catalog_version()
+    db.session.commit()
+    click.echo(f'Indexed {count} products')
+
+# Index maintenance
+def create_missing_indexes():
+    # create_all only indexes tables it creates, so add any that older
+    # databases lack. Cheap when nothing is missing, so serve runs it at startup.
+    with db.engine.begin() as connection:
+        inspector = db.inspect(connection)
+        missing = [index for model_table in db.metadata.sorted_tables for index in model_table.indexes
+                   if index.name not in {i['name'] for i in inspector.get_indexes(model_table.name)}]
+        
+        if any(index.name == 'uq_cart_customer_id_product_id' for index in missing):
+            # Fold duplicate cart lines together so the unique index can be built
+            connection.execute(text(
+                "UPDATE cart SET quantity = (SELECT sum(c.quantity) FROM cart c "
+                "WHERE c.customer_id = cart.customer_id AND c.product_id = cart.product_id) "
+                "WHERE id IN (SELECT min(id) FROM cart GROUP BY customer_id, product_id HAVING count(*) > 1)"
+            ))
+            connection.execute(text(
+                "DELETE FROM cart WHERE id NOT IN (SELECT min(id) FROM cart GROUP BY customer_id, product_id)"
+            ))
+        
+        for index in missing:
+            index.create(connection)
+    return [index.name for index in missing]
+
+def full_table_scans(statement, parameters=()):
+    # SQLite reports a plain "SCAN <table>" when it reads every row without an
+    # index. Scans of a subquery's result (SCAN anon_1) read rows already
+    # narrowed down and don't count. Takes SQL as the driver receives it, e.g.
+    # recorded through query_stats.on_statement() while benchmarks/routes.py
+    # replays traffic.
+    with db.engine.connect() as connection:
+        plan = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+    scans = [(row[3], re.fullmatch(r'SCAN (?:TABLE )?"?(\w+)"?(?: AS \w+)?', row[3])) for row in plan]
+    return [detail for detail, match in scans if match and match.group(1) in db.metadata.tables]
+
+@bp.cli.command('create-indexes')
+def create_indexes_command():
+    """Add any model indexes that an existing database is missing."""
+    db.create_all()
+    created = create_missing_indexes()
+    click.echo(f'Created {len(created)} indexes' + (': ' + ', '.join(created) if created else ''))
+
+@bp.cli.command('backfill-ratings')
+def backfill_ratings_command():
+    """Rebuild the per-product rating summaries from the review table."""
+    db.create_all()
+    count = rebuild_ratings()
+    bump_catalog_version()
+    db.session.commit()
+    click.echo(f'Rebuilt rating summaries for {count} products')
+
+# Synthetic data for load testing. The same options and seed always produce
+# the same database.
+SEED_PRODUCE = {
+    'Vegetables': ['Tomatoes', 'Carrots', 'Kale', 'Potatoes', 'Beets', 'Peppers', 'Zucchini', 'Onions'],
+    'Fruits': ['Apples', 'Pears', 'Strawberries', 'Peaches', 'Plums', 'Blueberries', 'Cherries', 'Melons'],
+    'Grains': ['Oats', 'Barley', 'Rye Flour', 'Spelt', 'Buckwheat', 'Cornmeal'],
+    'Dairy': ['Milk', 'Butter', 'Cheddar', 'Yogurt', 'Goat Cheese', 'Cream'],
+    'Meat': ['Chicken', 'Pork Chops', 'Ground Beef', 'Lamb', 'Sausages', 'Eggs'],
+    'Herbs': ['Basil', 'Mint', 'Thyme', 'Rosemary', 'Parsley', 'Cilantro'],
+    'Organic': ['Mixed Greens', 'Sweet Corn', 'Honey', 'Garlic', 'Squash', 'Spinach'],
+    'Other': ['Jam', 'Cider', 'Maple Syrup', 'Sourdough', 'Flowers', 'Pickles'],
+}
+SEED_ADJECTIVES = ['Fresh', 'Heirloom', 'Local', 'Free Range', 'Organic', 'Seasonal', 'Hand Picked', 'Small Batch']
+SEED_STATUSES = ['delivered'] * 6 + ['shipped'] * 2 + ['accepted', 'pending', 'cancelled']
+SEED_BATCH = 10000
+
+def seed_database(farmers, customers, products, reviews, carts, orders, days=180, seed=42):
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    password_hash = generate_password_hash('password')
+    
+    def insert_batches(model, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == SEED_BATCH:
+                db.session.execute(model.__table__.insert(), batch)
+                batch = []
+        if batch:
+            db.session.execute(model.__table__.insert(), batch)
+    
+    def moment():
+        return now - timedelta(seconds=rng.randrange(days * 24 * 3600))
+    
+    # Ids are assigned here rather than by the database, which is why the
+    # tables have to start out empty
+    farmer_ids = range(1, farmers + 1)
+    customer_ids = range(farmers + 1, farmers + customers + 1)
+    insert_batches(User, ({
+        'id': user_id,
+        'username': f'{user_type}{n}',
+        'email': f'{user_type}{n}@example.com',
+        'password_hash': password_hash,
+        'user_type': user_type,
+        'created_at': moment(),
+    } for user_type, ids in (('farmer', farmer_ids), ('customer', customer_ids))
+      for n, user_id in enumerate(ids, 1)))
+    
+    catalog = []
+    for product_id in range(1, products + 1):
+        category = rng.choice(PRODUCT_CATEGORIES)
+        item = rng.choice(SEED_PRODUCE[category])
+        catalog.append({
+            'id': product_id,
+            'name': f'{rng.choice(SEED_ADJECTIVES)} {item}',
+            'description': f'{item} grown by a local family farm and picked at its best.',
+            'price': round(rng.uniform(1, 40), 2),
+            'quantity': 0 if rng.random() < 0.05 else rng.randint(1, 500),
+            'category': category,
+            'farmer_id': rng.choice(farmer_ids),
+            'created_at': moment(),
+        })
+    insert_batches(Product, catalog)
+    
+    # A few products get most of the traffic, as in a real market
+    weights = list(itertools.accumulate(1 / (rank + 1) ** 0.8 for rank in range(products)))
+    def popular_products(k):
+        return sorted(set(rng.choices(range(products), cum_weights=weights, k=k)))
+    
+    def review_rows():
+        for review_id in range(1, reviews + 1):
+            product = catalog[popular_products(1)[0]]
+            yield {
+                'id': review_id,
+                'product_id': product['id'],
+                'customer_id': rng.choice(customer_ids),
+                'farmer_id': product['farmer_id'],
+                'rating': rng.choices(range(1, 6), weights=[1, 1, 3, 8, 12])[0],
+                'comment': rng.choice(['Great quality', 'Very fresh', 'Would buy again', 'Good value', '']),
+                'created_at': moment(),
+            }
+    insert_batches(Review, review_rows())
+    
+    def cart_rows():
+        for customer_id in rng.sample(customer_ids, min(carts, customers)):
+            for index in popular_products(rng.randint(1, 4)):
+                yield {'customer_id': customer_id, 'product_id': catalog[index]['id'],
+                       'quantity': rng.randint(1, 5)}
+    insert_batches(Cart, cart_rows())
+    
+    order_rows = []
+    def item_rows():
+        for order_id in range(1, orders + 1):
+            created_at = moment()
+            total = 0
+            for index in popular_products(rng.randint(1, 4)):
+                product = catalog[index]
+                quantity = rng.randint(1, 5)
+                total += quantity * product['price']
+                yield {'order_id': order_id, 'product_id': product['id'], 'quantity': quantity,
+                       'price': product['price'], 'farmer_id': product['farmer_id']}
+            status = rng.choice(SEED_STATUSES) if created_at < now - timedelta(days=2) else 'pending'
+            order_rows.append({'id': order_id, 'customer_id': rng.choice(customer_ids),
+                               'total_amount': round(total, 2), 'status': status,
+                               'created_at': created_at,
+                               'updated_at': created_at if status == 'pending' else
+                               min(created_at + timedelta(hours=rng.randint(1, 72)), now)})
+            if len(order_rows) == SEED_BATCH:
+                db.session.execute(Order.__table__.insert(), order_rows)
+                del order_rows[:]
+    insert_batches(OrderItem, item_rows())
+    if order_rows:
+        db.session.execute(Order.__table__.insert(), order_rows)
+    
+    # Derived tables, built the same way their maintenance commands do
+    rebuild_ratings()
+    rebuild_search_index()
+    rebuild_sales_rollups()
+    rebuild_recommendations()
+    bump_catalog_version()
+    return {
+        'farmers': farmers,
+        'customers': customers,
+        'products': products,
+        'reviews': reviews,
+        'cart lines': db.session.query(func.count(Cart.id)).scalar(),
+        'orders': orders,
+        'order items': db.session.query(func.count(OrderItem.id)).scalar(),
+    }
+
+@bp.cli.command('seed-data')
+@click.option('--farmers', default=50, show_default=True)
+@click.option('--customers', default=1000, show_default=True)
+@click.option('--products', default=5000, show_default=True)
+@click.option('--reviews', default=20000, show_default=True)
+@click.option('--carts', default=300, show_default=True, help='Customers with something in their cart.')
+@click.option('--orders', default=20000, show_default=True)
+@click.option('--days', default=180, show_default=True, help='How far back orders and reviews go.')
+@click.option('--seed', default=42, show_default=True)
+def seed_data_command(farmers, customers, products, reviews, carts, orders, days, seed):
+    """Fill an empty database with a reproducible synthetic market."""
+    db.create_all()
+    if db.session.query(User.id).first() or db.session.query(Product.id).first():
+        raise click.ClickException('seed-data needs an empty database; point DATABASE_URL at a new file')
+    if not farmers or not customers or not products:
+        raise click.ClickException('--farmers, --customers and --products must be at least 1')
+    
+    counts = seed_database(farmers, customers, products, reviews, carts, orders, days, seed)
+    db.session.commit()
+    catalog_cache.invalidate()
+    click.echo('Seeded ' + ', '.join(f'{count} {name}' for name, count in counts.items()))
+    click.echo("Every seeded user's password is 'password'")
+
+# Fingerprinted static assets, built by `flask build-assets`. Templates link
+# them through asset_url(), which falls back to the plain static file until a
+# build exists.
+ASSET_MAX_AGE = 365 * 24 * 3600
+ASSET_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+@bp.app_template_global()
+def asset_url(name):
+    path = asset_manifest.lookup(name)
+    if path is None:
+        return url_for('static', filename=name)
+    return url_for('market.asset', filename=path)
+
+@bp.app_template_global()
+def image_sources(name):
+    # One <source> per format, each with a srcset over the built widths
+    sources = {}
+    for variant in asset_manifest.image_variants(name):
+        sources.setdefault(variant['type'], []).\
+            append(f"{url_for('market.asset', filename=variant['path'])} {variant['width']}w")
+    return [{'type': mimetype, 'srcset': ', '.join(srcset)} for mimetype, srcset in sources.items()]
+
+@bp.route('/assets/<path:filename>')
+def asset(filename):
+    encodings = asset_manifest.encodings(filename)
+    if encodings is None:
+        abort(404)
+    
+    # The hashed name changes with the content, so clients can keep it forever
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    # best_match() honours q-values (`br;q=0` refuses brotli), and with no
+    # acceptable encoding the plain file is sent
+    encoding = request.accept_encodings.best_match(encodings)
+    response = send_from_directory(current_app.config['ASSET_DIR'], filename + ASSET_SUFFIXES.get(encoding, ''),
+                                   mimetype=mimetype, max_age=ASSET_MAX_AGE)
+    if encoding:
+        response.content_encoding = encoding
+    if encodings:
+        response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@bp.cli.command('build-assets')
+def build_assets_command():
+    """Write fingerprinted, precompressed copies of the static files."""
+    manifest = build_assets(current_app.static_folder, current_app.config['ASSET_DIR'])
+    for name, entry in sorted(manifest['files'].items()):
+        sizes = ', '.join(f'{encoding} {size}' for encoding, size in sorted(entry['encodings'].items()))
+        click.echo(f'{name} -> {entry["path"]} ({entry["size"]} bytes' + (f'; {sizes}' if sizes else '') + ')')
+    for name, variants in sorted(manifest['images'].items()):
+        for variant in variants:
+            click.echo(f'{name} -> {variant["path"]} ({variant["width"]}w, {variant["size"]} bytes)')
+
+# Product images. Product.image_url holds the media key of the original
+# upload; thumbnails are made from it in the background and served from
+# /media/ under names derived from that key.
+PRODUCT_IMAGE_WIDTHS = {
+    'card': (320, 640, 800),
+    'detail': (640, 800, 1600),
+}
+MEDIA_NAME = re.compile(r'products/[0-9a-f]{20}(?:-(?P<width>\d+)w\.webp|\.(?:jpg|png|webp))')
+
+@bp.app_template_global()
+def product_image(product, size='card'):
+    if not product.image_url:
+        return None
+    widths = PRODUCT_IMAGE_WIDTHS[size]
+    urls = [url_for('market.media', filename=thumbnail_name(product.image_url, width)) for width in widths]
+    return {'src': urls[0], 'srcset': ', '.join(f'{url} {width}w' for url, width in zip(urls, widths))}
+
+def store_product_image(product, upload):
+    # Only the original is written during the request; raises ValueError for
+    # files that aren't acceptable images
+    product.image_url = save_original(current_app.config['MEDIA_FOLDER'], upload.stream,
+                                      current_app.config['PRODUCT_IMAGE_MAX_BYTES'])
+    thumbnail_pool.submit(product.image_url)
+
+@bp.route('/media/<path:filename>')
+def media(filename):
+    match = MEDIA_NAME.fullmatch(filename)
+    if not match:
+        abort(404)
+    
+    if os.path.exists(os.path.join(current_app.config['MEDIA_FOLDER'], filename)):
+        # Names are derived from the content, so they never change
+        response = send_from_directory(current_app.config['MEDIA_FOLDER'], filename, max_age=ASSET_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+    
+    if match.group('width') is None:
+        abort(404)
+    # The thumbnail isn't ready: make sure it is queued (it may have been lost
+    # to a restart) and show the placeholder until it exists
+    stem = filename[:match.start('width') - 1]
+    originals = [stem + ext for ext in ('.jpg', '.png', '.webp')
+                 if os.path.exists(os.path.join(current_app.config['MEDIA_FOLDER'], stem + ext))]
+    if not originals:
+        abort(404)
+    thumbnail_pool.submit(originals[0])
+    response = send_from_directory(current_app.static_folder, 'images/placeholder.svg', max_age=0)
+    response.cache_control.no_store = True
+    return response
+
+@bp.cli.command('generate-thumbnails')
+def generate_thumbnails_command():
+    """Make any product image thumbnails that are missing."""
+    db.create_all()
+    keys = [key for (key,) in db.session.query(Product.image_url).
+            filter(Product.image_url.isnot(None)).
+            distinct()
+            if not thumbnails_ready(current_app.config['MEDIA_FOLDER'], key)]
+    failed = 0
+    for key in keys:
+        try:
+            make_thumbnails(current_app.config['MEDIA_FOLDER'], key)
+        except Exception as e:
+            failed += 1
+            click.echo(f'{key}: {e}')
+    click.echo(f'Made thumbnails for {len(keys) - failed} images' + (f', {failed} failed' if failed else ''))
 
 # Routes
-@app.route('/')
+@bp.route('/')
+@query_budget(4)
 def index():
-    products = Product.query.filter(Product.quantity > 0).limit(8).all()
-    return render_template('index.html', products=products)
+    return render_template('index.html', products=featured_products())
 
-@app.route('/about')
+@bp.route('/about')
 def about():
     return render_template('about.html')
 
-@app.route('/marketplace')
-def marketplace():
-    category = request.args.get('category', '')
-    search = request.args.get('search', '')
+# Marketplace listing helpers
+def encode_cursor(key, product_id):
+    raw = json.dumps([key, product_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor, parse_key):
+    # Raises ValueError for anything that isn't a cursor we handed out
+    try:
+        key, product_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return parse_key(key), int(product_id)
+    except TypeError as e:
+        raise ValueError('Invalid cursor') from e
+
+def listing_page(category, search, cursor=None, per_page=None):
+    # Keyset pagination: newest first on (created_at, id) when browsing,
+    # best bm25 rank first on (rank, id) when searching
+    per_page = per_page or current_app.config['PRODUCTS_PER_PAGE']
     
-    query = Product.query.filter(Product.quantity > 0)
+    query = Product.query.\
+        outerjoin(ProductRating, ProductRating.product_id == Product.id).\
+        options(contains_eager(Product.rating), joinedload(Product.farmer)).\
+        filter(Product.quantity > 0)
     
     if category:
         query = query.filter(Product.category == category)
-    if search:
-        query = query.filter(Product.name.contains(search))
-    
-    products = query.all()
     
-    # Calculate average ratings for each product
+    if search:
+        expression = search_expression(search)
+        if expression is None:
+            return [], None
+        query = query.join(product_search, product_search.c.rowid == Product.id).\
+            filter(column('product_search').match(expression)).\
+            add_columns(search_rank)
+        if cursor:
+            rank, product_id = decode_cursor(cursor, float)
+            query = query.filter(or_(
+                search_rank > rank,
+                and_(search_rank == rank, Product.id > product_id)
+            ))
+        query = query.order_by(search_rank, Product.id)
+    else:
+        query = query.add_columns(Product.created_at)
+        if cursor:
+            created_at, product_id = decode_cursor(cursor, datetime.fromisoformat)
+            query = query.filter(or_(
+                Product.created_at < created_at,
+                and_(Product.created_at == created_at, Product.id < product_id)
+            ))
+        query = query.order_by(Product.created_at.desc(), Product.id.desc())
+    
+    rows = query.limit(per_page + 1).all()
+    
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        product, key = rows[-1]
+        next_cursor = encode_cursor(key if search else key.isoformat(), product.id)
+    products = [product for product, key in rows]
+    
+    # Average ratings come from the stored summary joined in above
     for product in products:
-        product_reviews = Review.query.filter_by(product_id=product.id).all()
-        if product_reviews:
-            product.avg_rating = sum(review.rating for review in product_reviews) / len(product_reviews)
-            product.avg_rating = round(product.avg_rating, 1)
-            product.review_count = len(product_reviews)
+        if product.rating:
+            product.avg_rating = product.rating.average
+            product.review_count = product.rating.rating_count
         else:
             product.avg_rating = 0
             product.review_count = 0
     
-    categories = db.session.query(Product.category).distinct().all()
-    categories = [cat[0] for cat in categories if cat[0]]
+    return products, next_cursor
+
+@bp.route('/marketplace')
+@query_budget(5)
+@catalog_etag
+def marketplace():
+    category = request.args.get('category', '')
+    search = request.args.get('search', '')
     
-    return render_template('marketplace.html', products=products, categories=categories)
+    try:
+        products, next_cursor = listing_page(category, search, request.args.get('cursor'))
+    except ValueError:
+        return redirect(url_for('market.marketplace', category=category, search=search))
+    
+    return render_template('marketplace.html', products=products, categories=catalog_categories(),
+                           next_cursor=next_cursor)
+
+@bp.route('/api/products')
+@query_budget(2)
+def api_products():
+    category = request.args.get('category', '')
+    search = request.args.get('search', '')
+    per_page = min(request.args.get('limit', current_app.config['PRODUCTS_PER_PAGE'], type=int), 100)
+    
+    try:
+        products, next_cursor = listing_page(category, search, request.args.get('cursor'),
+                                             max(per_page, 1))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
+    
+    return jsonify({
+        'success': True,
+        'products': [{
+            'id': product.id,
+            'name': product.name,
+            'description': product.description or '',
+            'price': product.price,
+            'quantity': product.quantity,
+            'category': product.category,
+            'farmer': product.farmer.username,
+            'avg_rating': product.avg_rating,
+            'review_count': product.review_count,
+            'url': url_for('market.product_details', product_id=product.id),
+            'image': product_image(product),
+        } for product in products],
+        'next_cursor': next_cursor,
+    })
+
+@bp.route('/api/suggest')
+@query_budget(2)
+def api_suggest():
+    limit = min(max(request.args.get('limit', current_app.config['SUGGEST_LIMIT'], type=int), 1), 20)
+    if suggest_index.needs_check():
+        refresh_suggestions()
+    
+    suggestions = suggest_index.search(request.args.get('q', '')[:100], limit)
+    response = jsonify({
+        'success': True,
+        'suggestions': [dict(suggestion, url=url_for('market.product_details', product_id=suggestion['id']))
+                        for suggestion in suggestions],
+    })
+    # The same for every visitor, and no fresher than the index itself
+    response.headers['Cache-Control'] = f'public, max-age={current_app.config["SUGGEST_REFRESH"]}'
+    return response
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         username = request.form['username']
@@ -148,11 +1239,11 @@ def register():
         
         if User.query.filter_by(username=username).first():
             flash('Username already exists')
-            return redirect(url_for('register'))
+            return redirect(url_for('market.register'))
         
         if User.query.filter_by(email=email).first():
             flash('Email already registered')
-            return redirect(url_for('register'))
+            return redirect(url_for('market.register'))
         
         user = User(
             username=username,
@@ -165,11 +1256,11 @@ def register():
         db.session.commit()
         
         flash('Registration successful! Please login.')
-        return redirect(url_for('login'))
+        return redirect(url_for('market.login'))
     
     return render_template('register.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -178,21 +1269,25 @@ def login():
         
         if user and check_password_hash(user.password_hash, password):
             login_user(user)
+            session.pop('cart_units', None)
+            if user.user_type == 'customer':
+                session['cart_units'] = cart_summary(user.id)['units']
             flash('Login successful!')
-            return redirect(url_for('dashboard'))
+            return redirect(url_for('market.dashboard'))
         else:
             flash('Invalid username or password')
     
     return render_template('login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
     logout_user()
+    session.pop('cart_units', None)
     flash('You have been logged out')
-    return redirect(url_for('index'))
+    return redirect(url_for('market.index'))
 
-@app.route('/dashboard')
+@bp.route('/dashboard')
 @login_required
 def dashboard():
     if current_user.user_type == 'farmer':
@@ -214,23 +1309,26 @@ def dashboard():
                              total_orders=total_orders,
                              cart_items_count=cart_items_count)
 
-@app.route('/profile', methods=['GET', 'POST'])
+@bp.route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
     if request.method == 'POST':
-        current_user.email = request.form['email']
+        User.query.filter_by(id=current_user.id).update({'email': request.form['email']})
         db.session.commit()
+        forget_user(current_user.id)
         flash('Profile updated successfully!')
-        return redirect(url_for('profile'))
+        return redirect(url_for('market.profile'))
     
-    return render_template('profile.html')
+    # current_user is the cached identity, which doesn't carry created_at
+    user = db.session.get(User, current_user.id)
+    return render_template('profile.html', user=user)
 
-@app.route('/add_product', methods=['GET', 'POST'])
+@bp.route('/add_product', methods=['GET', 'POST'])
 @login_required
 def add_product():
     if current_user.user_type != 'farmer':
         flash('Only farmers can add products')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('market.dashboard'))
     
     if request.method == 'POST':
         product = Product(
@@ -242,140 +1340,347 @@ def add_product():
             farmer_id=current_user.id
         )
         
+        image = request.files.get('image')
+        if image and image.filename:
+            try:
+                store_product_image(product, image)
+            except ValueError as e:
+                flash(str(e))
+                return render_template('add_product.html')
+        
         db.session.add(product)
+        db.session.flush()
+        index_products([product])
+        bump_catalog_version()
+        version = catalog_version()
         db.session.commit()
+        catalog_cache.invalidate()
+        suggest_index.add(product.id, product.name, product.category, product.quantity)
+        suggest_index.advance(version)
         flash('Product added successfully!')
-        return redirect(url_for('my_products'))
+        return redirect(url_for('market.my_products'))
     
     return render_template('add_product.html')
 
-@app.route('/my_products')
+@bp.route('/import_products', methods=['GET', 'POST'])
+@login_required
+def import_products():
+    if current_user.user_type != 'farmer':
+        flash('Only farmers can import products')
+        return redirect(url_for('market.dashboard'))
+    
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Please choose a CSV file to import')
+            return redirect(url_for('market.import_products'))
+        
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        try:
+            result = import_products_csv(stream, current_user.id)
+        except (ValueError, csv.Error) as e:
+            # Bad header, or a header that isn't UTF-8; nothing was imported
+            db.session.rollback()
+            flash(f'Could not import the file: {e}')
+            return redirect(url_for('market.import_products'))
+        
+        return render_template('import_products.html', result=result, categories=PRODUCT_CATEGORIES)
+    
+    return render_template('import_products.html', result=None, categories=PRODUCT_CATEGORIES)
+
+@bp.route('/my_products')
 @login_required
 def my_products():
     if current_user.user_type != 'farmer':
         flash('Only farmers can view their products')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('market.dashboard'))
     
     products = Product.query.filter_by(farmer_id=current_user.id).all()
     return render_template('my_products.html', products=products)
 
-@app.route('/cart')
+# Cart changes
+CART_OPS = ('set', 'increment', 'remove')
+
+def cart_summary(customer_id):
+    lines, units, total = db.session.query(func.count(Cart.id),
+                                           func.coalesce(func.sum(Cart.quantity), 0),
+                                           func.coalesce(func.sum(Cart.quantity * Product.price), 0)).\
+        join(Product, Cart.product_id == Product.id).\
+        filter(Cart.customer_id == customer_id).\
+        one()
+    return {'lines': lines, 'units': units, 'total': round(total, 2)}
+
+def apply_cart_changes(customer_id, changes):
+    # Stock and the current cart lines for every product mentioned come back
+    # in one query; the new quantities are written with one upsert and one
+    # delete. The caller commits.
+    product_ids = {change['product_id'] for change in changes}
+    rows = db.session.query(Product.id, Product.quantity, Cart.quantity).\
+        outerjoin(Cart, and_(Cart.product_id == Product.id, Cart.customer_id == customer_id)).\
+        filter(Product.id.in_(product_ids)).\
+        all()
+    stock = {product_id: in_stock for product_id, in_stock, _ in rows}
+    current = {product_id: in_cart for product_id, _, in_cart in rows if in_cart is not None}
+    wanted = dict(current)
+    
+    results = []
+    for change in changes:
+        product_id = change['product_id']
+        if product_id not in stock:
+            results.append({'product_id': product_id, 'success': False, 'message': 'Product not found'})
+            continue
+        
+        quantity = wanted.get(product_id, 0)
+        if change['op'] == 'set':
+            quantity = change['quantity']
+        elif change['op'] == 'increment':
+            quantity += change['quantity']
+        else:
+            quantity = 0
+        
+        # Lowering or clearing a line is always allowed, even for products
+        # that have since sold out
+        if quantity > stock[product_id] and quantity > wanted.get(product_id, 0):
+            results.append({'product_id': product_id, 'success': False, 'message': 'Not enough stock',
+                            'quantity': wanted.get(product_id, 0), 'in_stock': stock[product_id]})
+            continue
+        wanted[product_id] = quantity
+        results.append({'product_id': product_id, 'success': True, 'quantity': quantity})
+    
+    upserts = [{'customer_id': customer_id, 'product_id': product_id, 'quantity': quantity}
+               for product_id, quantity in wanted.items()
+               if quantity > 0 and quantity != current.get(product_id)]
+    removed = [product_id for product_id, quantity in wanted.items()
+               if quantity <= 0 and product_id in current]
+    
+    if upserts:
+        statement = sqlite_insert(Cart.__table__)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['customer_id', 'product_id'],
+            set_={'quantity': statement.excluded.quantity}), upserts)
+    if removed:
+        db.session.execute(Cart.__table__.delete().
+                           where(Cart.customer_id == customer_id, Cart.product_id.in_(removed)))
+    
+    summary = cart_summary(customer_id)
+    # The navbar badge reads this, so pages don't need a cart query
+    session['cart_units'] = summary['units']
+    return results, summary
+
+@bp.app_context_processor
+def inject_cart_units():
+    if not current_user.is_authenticated or current_user.user_type != 'customer':
+        return {}
+    if 'cart_units' not in session:
+        # Only a session that didn't go through login() (remember-me cookie,
+        # or one from before a deploy) gets here, once. Budgets of pages
+        # customers see leave room for this query.
+        session['cart_units'] = cart_summary(current_user.id)['units']
+    return {'cart_units': session['cart_units']}
+
+@bp.route('/cart')
+@query_budget(2)
 @login_required
 def cart():
     if current_user.user_type != 'customer':
         flash('Only customers can view cart')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('market.dashboard'))
     
-    cart_items = Cart.query.filter_by(customer_id=current_user.id).all()
+    cart_items = Cart.query.filter_by(customer_id=current_user.id).\
+        options(joinedload(Cart.product)).\
+        all()
     total = 0
     for item in cart_items:
         if item.product:
             total += item.quantity * item.product.price
+    # Refresh the navbar badge from the lines already loaded
+    session['cart_units'] = sum(item.quantity for item in cart_items if item.product)
     return render_template('cart.html', cart_items=cart_items, total=total)
 
-@app.route('/add_to_cart/<int:product_id>', methods=['POST'])
+@bp.route('/add_to_cart/<int:product_id>', methods=['POST'])
 @login_required
 def add_to_cart(product_id):
     if current_user.user_type != 'customer':
         return jsonify({'success': False, 'message': 'Only customers can add to cart'})
     
-    product = Product.query.get_or_404(product_id)
-    quantity = int(request.form.get('quantity', 1))
-    
-    if quantity > product.quantity:
-        return jsonify({'success': False, 'message': 'Not enough stock'})
+    quantity = request.form.get('quantity', 1, type=int)
+    if quantity < 1:
+        return jsonify({'success': False, 'message': 'Quantity must be at least 1'})
     
-    cart_item = Cart.query.filter_by(customer_id=current_user.id, product_id=product_id).first()
-    
-    if cart_item:
-        new_quantity = cart_item.quantity + quantity
-        if new_quantity > product.quantity:
-            return jsonify({'success': False, 'message': 'Not enough stock'})
-        cart_item.quantity = new_quantity
-    else:
-        cart_item = Cart(customer_id=current_user.id, product_id=product_id, quantity=quantity)
-        db.session.add(cart_item)
+    results, summary = apply_cart_changes(current_user.id, [
+        {'product_id': product_id, 'op': 'increment', 'quantity': quantity}])
+    if not results[0]['success']:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': results[0]['message']})
     
     db.session.commit()
-    return jsonify({'success': True, 'message': 'Product added to cart'})
+    return jsonify({'success': True, 'message': 'Product added to cart', 'cart': summary})
 
-@app.route('/remove_from_cart/<int:cart_item_id>', methods=['POST'])
+# Apply several cart changes at once, e.g. a burst of Add to Cart clicks
+@bp.route('/api/cart', methods=['POST'])
+@query_budget(5)
+@login_required
+def api_cart():
+    if current_user.user_type != 'customer':
+        return jsonify({'success': False, 'message': 'Only customers can change a cart'}), 403
+    
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({'success': False, 'message': 'Send a JSON object with a changes list'}), 400
+    changes = payload.get('changes')
+    if not isinstance(changes, list) or not changes:
+        return jsonify({'success': False, 'message': 'changes must be a non-empty list'}), 400
+    if len(changes) > current_app.config['CART_BATCH_LIMIT']:
+        return jsonify({'success': False,
+                        'message': f'At most {current_app.config["CART_BATCH_LIMIT"]} cart changes can be sent at once'}), 400
+    
+    for change in changes:
+        if not isinstance(change, dict) or change.get('op') not in CART_OPS or \
+                not isinstance(change.get('product_id'), int) or isinstance(change['product_id'], bool):
+            return jsonify({'success': False, 'message': 'Each change needs a product_id and an op of '
+                            + ', '.join(CART_OPS)}), 400
+        if change['op'] == 'remove':
+            continue
+        quantity = change.get('quantity', 1 if change['op'] == 'increment' else None)
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or \
+                quantity < (1 if change['op'] == 'increment' else 0):
+            return jsonify({'success': False, 'message': f'Invalid quantity for product {change["product_id"]}'}), 400
+        change['quantity'] = quantity
+    
+    try:
+        results, summary = apply_cart_changes(current_user.id, changes)
+        db.session.commit()
+    except OperationalError:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'The market is busy right now, please try again'}), 503
+    
+    return jsonify({'success': True, 'results': results, 'cart': summary})
+
+@bp.route('/remove_from_cart/<int:cart_item_id>', methods=['POST'])
 @login_required
 def remove_from_cart(cart_item_id):
     if current_user.user_type != 'customer':
         flash('Only customers can remove from cart')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('market.dashboard'))
     
     cart_item = Cart.query.filter_by(id=cart_item_id, customer_id=current_user.id).first()
     if cart_item:
+        quantity = cart_item.quantity
         db.session.delete(cart_item)
         db.session.commit()
+        if 'cart_units' in session:
+            session['cart_units'] = max(session['cart_units'] - quantity, 0)
         flash('Item removed from cart')
     
-    return redirect(url_for('cart'))
+    return redirect(url_for('market.cart'))
 
-@app.route('/checkout', methods=['POST'])
-@login_required
-def checkout():
-    if current_user.user_type != 'customer':
-        flash('Only customers can checkout')
-        return redirect(url_for('dashboard'))
-    
-    cart_items = Cart.query.filter_by(customer_id=current_user.id).all()
-    
+# Checkout
+class CheckoutError(Exception):
+    pass
+
+def place_order(customer_id):
+    # Everything happens in the caller's transaction. Stock is claimed with
+    # conditional UPDATEs, so concurrent buyers can't oversell, and a failed
+    # checkout rolls back without leaving an order behind.
+    cart_items = Cart.query.filter_by(customer_id=customer_id).\
+        order_by(Cart.product_id).\
+        all()
     if not cart_items:
-        flash('Your cart is empty')
-        return redirect(url_for('cart'))
+        raise CheckoutError('Your cart is empty')
     
-    # Create order
-    total_amount = sum(item.quantity * item.product.price for item in cart_items)
-    order = Order(customer_id=current_user.id, total_amount=total_amount, status='pending')
-    db.session.add(order)
-    db.session.commit()
+    products = Product.query.filter(Product.id.in_([item.product_id for item in cart_items])).all()
+    products = {product.id: product for product in products}
     
-    # Create order items and update product quantities
-    for cart_item in cart_items:
-        product = Product.query.get(cart_item.product_id)
-        if product.quantity < cart_item.quantity:
-            db.session.rollback()
-            flash(f'Not enough stock for {product.name}')
-            return redirect(url_for('cart'))
+    for item in cart_items:
+        product = products.get(item.product_id)
+        if product is None:
+            raise CheckoutError('An item in your cart is no longer available')
         
-        product.quantity -= cart_item.quantity
-        order_item = OrderItem(
-            order_id=order.id,
-            product_id=cart_item.product_id,
-            quantity=cart_item.quantity,
-            price=product.price,
-            farmer_id=product.farmer_id  # Track which farmer needs to fulfill this item
-        )
-        db.session.add(order_item)
+        claimed = db.session.execute(
+            update(Product).
+            where(Product.id == item.product_id, Product.quantity >= item.quantity).
+            values(quantity=Product.quantity - item.quantity).
+            execution_options(synchronize_session=False)
+        ).rowcount
+        if not claimed:
+            raise CheckoutError(f'Not enough stock for {product.name}')
+    
+    # Clearing the cart by id also stops a double-submitted checkout from
+    # ordering the same cart twice
+    cleared = Cart.query.filter(Cart.id.in_([item.id for item in cart_items])).\
+        delete(synchronize_session=False)
+    if cleared != len(cart_items):
+        raise CheckoutError('Your cart changed during checkout, please review it and try again')
+    
+    total_amount = sum(item.quantity * products[item.product_id].price for item in cart_items)
+    now = datetime.utcnow()
+    order = Order(customer_id=customer_id, total_amount=total_amount, status='pending',
+                  created_at=now, updated_at=now)
+    db.session.add(order)
+    db.session.flush()
+    
+    order_items = [{
+        'order_id': order.id,
+        'product_id': item.product_id,
+        'quantity': item.quantity,
+        'price': products[item.product_id].price,
+        'farmer_id': products[item.product_id].farmer_id,  # Track which farmer needs to fulfill this item
+    } for item in cart_items]
+    db.session.execute(insert(OrderItem), order_items)
+    apply_to_rollups(now.date(), [(item['farmer_id'], item['product_id'], item['quantity'], item['price'])
+                                  for item in order_items])
+    record_co_purchases([item['product_id'] for item in order_items])
+    
+    bump_catalog_version()
+    return order
+
+@bp.route('/checkout', methods=['POST'])
+@login_required
+def checkout():
+    if current_user.user_type != 'customer':
+        flash('Only customers can checkout')
+        return redirect(url_for('market.dashboard'))
     
-    # Clear cart
-    Cart.query.filter_by(customer_id=current_user.id).delete()
-    db.session.commit()
+    try:
+        order = place_order(current_user.id)
+        messages = order_events('order_created', [order])
+        db.session.commit()
+    except CheckoutError as e:
+        db.session.rollback()
+        flash(str(e))
+        return redirect(url_for('market.cart'))
+    except OperationalError:
+        # SQLite gave up waiting for the write lock
+        db.session.rollback()
+        flash('The market is busy right now, please try checking out again')
+        return redirect(url_for('market.cart'))
+    
+    # Stock levels changed, and sold-out products drop off the featured list
+    catalog_cache.invalidate()
+    publish_events(messages)
+    session['cart_units'] = 0
     
     flash('Order placed successfully!')
-    return redirect(url_for('orders'))
+    return redirect(url_for('market.orders'))
 
-@app.route('/orders')
+@bp.route('/orders')
 @login_required
 def orders():
     if current_user.user_type != 'customer':
         flash('Only customers can view orders')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('market.dashboard'))
     
     # Get orders for the current customer
     orders = Order.query.filter_by(customer_id=current_user.id).order_by(Order.created_at.desc()).all()
     
     return render_template('orders.html', orders=orders)
 
-@app.route('/add_review/<int:product_id>', methods=['GET', 'POST'])
+@bp.route('/add_review/<int:product_id>', methods=['GET', 'POST'])
 @login_required
 def add_review(product_id):
     if current_user.user_type != 'customer':
         flash('Only customers can add reviews')
-        return redirect(url_for('marketplace'))
+        return redirect(url_for('market.marketplace'))
     
     product = Product.query.get_or_404(product_id)
     
@@ -384,7 +1689,7 @@ def add_review(product_id):
     
     if not has_purchased:
         flash('You can only review products you have purchased')
-        return redirect(url_for('product_details', product_id=product_id))
+        return redirect(url_for('market.product_details', product_id=product_id))
     
     # Check if user already reviewed this product
     existing_review = Review.query.filter_by(
@@ -394,12 +1699,16 @@ def add_review(product_id):
     
     if existing_review:
         flash('You have already reviewed this product')
-        return redirect(url_for('product_details', product_id=product_id))
+        return redirect(url_for('market.product_details', product_id=product_id))
     
     if request.method == 'POST':
         rating = int(request.form['rating'])
         comment = request.form['comment']
         
+        if rating not in range(1, 6):
+            flash('Rating must be between 1 and 5')
+            return redirect(url_for('market.add_review', product_id=product_id))
+        
         review = Review(
             product_id=product_id,
             customer_id=current_user.id,
@@ -409,24 +1718,27 @@ def add_review(product_id):
         )
         
         db.session.add(review)
+        record_rating(product_id, rating)
+        bump_catalog_version()
         db.session.commit()
         
         flash('Review added successfully!')
-        return redirect(url_for('product_details', product_id=product_id))
+        return redirect(url_for('market.product_details', product_id=product_id))
     
     return render_template('add_review.html', product=product)
 
-@app.route('/product/<int:product_id>')
+@bp.route('/product/<int:product_id>')
+@query_budget(7)
+@catalog_etag
 def product_details(product_id):
-    product = Product.query.get_or_404(product_id)
-    reviews = Review.query.filter_by(product_id=product_id).all()
+    product = Product.query.options(joinedload(Product.farmer), joinedload(Product.rating)).\
+        get_or_404(product_id)
+    reviews = Review.query.filter_by(product_id=product_id).\
+        options(joinedload(Review.author)).\
+        all()
     
-    # Calculate average rating
-    if reviews:
-        avg_rating = sum(review.rating for review in reviews) / len(reviews)
-        avg_rating = round(avg_rating, 1)
-    else:
-        avg_rating = 0
+    # Average rating comes from the stored summary
+    avg_rating = product.rating.average if product.rating else 0
     
     # For demo purposes, allow all customers to review
     can_review = False
@@ -442,15 +1754,16 @@ def product_details(product_id):
                          product=product, 
                          reviews=reviews, 
                          avg_rating=avg_rating,
-                         can_review=can_review)
+                         can_review=can_review,
+                         recommended=recommended_products(product_id).all())
 
 
-@app.route('/farmer_reviews')
+@bp.route('/farmer_reviews')
 @login_required
 def farmer_reviews():
     if current_user.user_type != 'farmer':
         flash('Only farmers can view this page')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('market.dashboard'))
     
     # Use join to get all data in one query
     reviews_data = db.session.query(Review, Product, User).\
@@ -460,35 +1773,48 @@ def farmer_reviews():
         filter(Review.farmer_id == current_user.id).\
         all()
     
-    # Calculate average rating for farmer
-    if reviews_data:
-        avg_rating = sum(review.rating for review, product, customer in reviews_data) / len(reviews_data)
-        avg_rating = round(avg_rating, 1)
-    else:
-        avg_rating = 0
+    # Average rating for farmer, summed from the stored per-product totals
+    rating_sum, rating_count = db.session.query(
+        func.sum(ProductRating.rating_sum), func.sum(ProductRating.rating_count)
+    ).join(Product, ProductRating.product_id == Product.id).\
+        filter(Product.farmer_id == current_user.id).\
+        first()
+    avg_rating = round(rating_sum / rating_count, 1) if rating_count else 0
     
     return render_template('farmer_reviews.html', reviews_data=reviews_data, avg_rating=avg_rating)
 
-@app.route('/contact')
+@bp.route('/contact')
 def contact():
     return render_template('contact.html')
 
-@app.route('/terms')
+@bp.route('/terms')
 def terms():
     return render_template('terms.html')
 
+# Prometheus scrape endpoint
+@bp.route('/metrics')
+@query_budget(0)
+def metrics():
+    token = current_app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(401)
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4',
+                    headers={'Cache-Control': 'no-store'})
+
 
 # Farmer orders page
-@app.route('/farmer_orders')
+@bp.route('/farmer_orders')
+@query_budget(3)
 @login_required
 def farmer_orders():
     if current_user.user_type != 'farmer':
         flash('Only farmers can view orders')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('market.dashboard'))
     
     # Get orders that contain products from this farmer
     orders = db.session.query(Order).\
         join(OrderItem).\
+        options(joinedload(Order.customer)).\
         filter(OrderItem.farmer_id == current_user.id).\
         group_by(Order.id).\
         all()
@@ -498,8 +1824,147 @@ def farmer_orders():
     
     return render_template('farmer_orders.html', orders=orders, order_items=order_items)
 
+# Farmer order export. Rows stream from the database cursor straight into the
+# response, so memory use doesn't depend on how many orders are exported.
+EXPORT_COLUMNS = ['order_id', 'order_date', 'status', 'customer', 'customer_email', 'product_id', 'product',
+                  'category', 'quantity', 'unit_price', 'line_total']
+EXPORT_BATCH = 1000
+
+def farmer_export_query(farmer_id, start=None, end=None):
+    # One statement over live and archived orders. Each half walks the
+    # (farmer_id, order_id) item index in order, so SQLite merges the two
+    # without sorting the whole export first.
+    parts = []
+    for orders, items in ((Order, OrderItem), (ArchivedOrder, ArchivedOrderItem)):
+        query = select(items.order_id, items.id.label('item_id'), orders.created_at, orders.status,
+                       User.username, User.email, items.product_id, Product.name, Product.category,
+                       items.quantity, items.price).\
+            select_from(items).\
+            join(orders, items.order_id == orders.id).\
+            join(User, orders.customer_id == User.id).\
+            outerjoin(Product, items.product_id == Product.id).\
+            where(items.farmer_id == farmer_id)
+        if start:
+            query = query.where(orders.created_at >= start)
+        if end:
+            query = query.where(orders.created_at < end + timedelta(days=1))
+        parts.append(query)
+    return union_all(*parts).order_by('order_id', 'item_id')
+
+def csv_cell(value):
+    # Keep spreadsheet apps from running text that looks like a formula
+    if isinstance(value, str) and value[:1] in ('=', '+', '-', '@'):
+        return "'" + value
+    return value
+
+def export_rows(statement):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    result = db.session.execute(statement, execution_options={'yield_per': EXPORT_BATCH})
+    try:
+        for rows in result.partitions():
+            for order_id, _, created_at, status, customer, email, product_id, name, category, quantity, price in rows:
+                writer.writerow([order_id, created_at.strftime('%Y-%m-%d %H:%M:%S'), status, csv_cell(customer),
+                                 csv_cell(email), product_id, csv_cell(name or 'Removed product'), csv_cell(category),
+                                 quantity, f'{price:.2f}', f'{quantity * price:.2f}'])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    finally:
+        result.close()
+
+@bp.route('/farmer_orders/export')
+@login_required
+def export_farmer_orders():
+    if current_user.user_type != 'farmer':
+        flash('Only farmers can export orders')
+        return redirect(url_for('market.dashboard'))
+    
+    try:
+        start, end = (datetime.strptime(request.args[name], '%Y-%m-%d') if request.args.get(name) else None
+                      for name in ('start', 'end'))
+    except ValueError:
+        flash('Dates must look like 2024-01-31')
+        return redirect(url_for('market.farmer_orders'))
+    
+    filename = 'orders' + (start.strftime('-from-%Y-%m-%d') if start else '') + \
+        (end.strftime('-to-%Y-%m-%d') if end else '') + '.csv'
+    # stream_with_context keeps the request, and with it the database
+    # session, open until the last row is sent
+    rows = stream_with_context(export_rows(farmer_export_query(current_user.id, start, end)))
+    return Response(rows, mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"',
+                             'Cache-Control': 'no-store'})
+
+# Live order updates as Server-Sent Events
+@bp.route('/events')
+@login_required
+def events():
+    subscription = broker.subscribe(f'user:{current_user.id}')
+    
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                message = subscription.get(timeout=15)
+                if message is None:
+                    # Comment line keeps proxies from closing an idle stream
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f"event: {message['event']}\ndata: {json.dumps(message['data'])}\n\n"
+        finally:
+            subscription.close()
+    
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Archived orders, newest first, a page at a time
+def order_history_query(user_id, user_type, before=None):
+    query = db.session.query(ArchivedOrder, User.username).\
+        join(User, ArchivedOrder.customer_id == User.id)
+    if user_type == 'farmer':
+        # Orders holding this farmer's products, found through the item index
+        order_ids = db.session.query(ArchivedOrderItem.order_id).\
+            filter(ArchivedOrderItem.farmer_id == user_id)
+        if before:
+            order_ids = order_ids.filter(ArchivedOrderItem.order_id < before)
+        query = query.filter(ArchivedOrder.id.in_(order_ids))
+    else:
+        query = query.filter(ArchivedOrder.customer_id == user_id)
+    if before:
+        query = query.filter(ArchivedOrder.id < before)
+    return query.order_by(ArchivedOrder.id.desc())
+
+def archived_items_query(order_ids, farmer_id=None):
+    query = db.session.query(ArchivedOrderItem, Product.name).\
+        outerjoin(Product, ArchivedOrderItem.product_id == Product.id).\
+        filter(ArchivedOrderItem.order_id.in_(order_ids))
+    if farmer_id:
+        query = query.filter(ArchivedOrderItem.farmer_id == farmer_id)
+    return query
+
+@bp.route('/order_history')
+@query_budget(4)
+@login_required
+def order_history():
+    per_page = current_app.config['ORDER_HISTORY_PER_PAGE']
+    rows = order_history_query(current_user.id, current_user.user_type, request.args.get('before', type=int)).\
+        limit(per_page + 1).\
+        all()
+    next_before = rows[per_page - 1][0].id if len(rows) > per_page else None
+    rows = rows[:per_page]
+    
+    items = defaultdict(list)
+    if rows:
+        farmer_id = current_user.id if current_user.user_type == 'farmer' else None
+        for item, product_name in archived_items_query([order.id for order, _ in rows], farmer_id):
+            items[item.order_id].append((item, product_name))
+    
+    return render_template('order_history.html', rows=rows, items=items, next_before=next_before)
+
 # Update order status
-@app.route('/update_order_status/<int:order_id>', methods=['POST'])
+@bp.route('/update_order_status/<int:order_id>', methods=['POST'])
 @login_required
 def update_order_status(order_id):
     if current_user.user_type != 'farmer':
@@ -513,69 +1978,153 @@ def update_order_status(order_id):
         return jsonify({'success': False, 'message': 'Order not found'})
     
     new_status = request.form.get('status')
-    valid_statuses = ['pending', 'accepted', 'shipped', 'delivered', 'cancelled']
     
-    if new_status not in valid_statuses:
+    if new_status not in ORDER_STATUSES:
         return jsonify({'success': False, 'message': 'Invalid status'})
     
-    order.status = new_status
-    order.updated_at = datetime.utcnow()
+    set_order_statuses([order], new_status)
+    messages = order_events('order_status', [order])
     db.session.commit()
+    publish_events(messages)
     
     return jsonify({'success': True, 'message': f'Order status updated to {new_status}'})
 
+# Update many orders at once
+@bp.route('/api/orders/status', methods=['POST'])
+@query_budget(8)
+@login_required
+def batch_update_order_status():
+    if current_user.user_type != 'farmer':
+        return jsonify({'success': False, 'message': 'Only farmers can update orders'}), 403
+    
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({'success': False, 'message': 'Send a JSON object with status and order_ids'}), 400
+    new_status = payload.get('status')
+    order_ids = payload.get('order_ids')
+    
+    if new_status not in ORDER_STATUSES:
+        return jsonify({'success': False, 'message': 'Invalid status'}), 400
+    if not isinstance(order_ids, list) or \
+            not all(isinstance(order_id, int) and not isinstance(order_id, bool) for order_id in order_ids):
+        return jsonify({'success': False, 'message': 'order_ids must be a list of order ids'}), 400
+    if len(order_ids) > current_app.config['ORDER_BATCH_LIMIT']:
+        return jsonify({'success': False,
+                        'message': f'At most {current_app.config["ORDER_BATCH_LIMIT"]} orders can be updated at once'}), 400
+    
+    # One query proves which of the orders contain this farmer's products
+    owned_ids = {order_id for (order_id,) in db.session.query(OrderItem.order_id).
+                 filter(OrderItem.farmer_id == current_user.id, OrderItem.order_id.in_(order_ids)).
+                 distinct()}
+    orders = Order.query.options(joinedload(Order.customer)).\
+        filter(Order.id.in_(owned_ids)).\
+        all() if owned_ids else []
+    
+    # Read what the response needs before commit expires the orders
+    updated = {order.id for order in orders}
+    updated_at = None
+    if orders:
+        updated_at = set_order_statuses(orders, new_status).strftime('%Y-%m-%d %H:%M')
+        messages = order_events('order_status', orders)
+        db.session.commit()
+        publish_events(messages)
+    
+    results = []
+    for order_id in dict.fromkeys(order_ids):
+        if order_id in updated:
+            results.append({'order_id': order_id, 'success': True, 'status': new_status,
+                            'updated_at': updated_at})
+        else:
+            results.append({'order_id': order_id, 'success': False, 'message': 'Order not found'})
+    
+    return jsonify({'success': True, 'updated': len(updated), 'results': results})
+
+# Farmer sales analytics
+def analytics_args():
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
+    window = min(max(request.args.get('window', 7, type=int), 1), days)
+    return days, window
+
+@bp.route('/farmer_analytics')
+@query_budget(3)
+@login_required
+def farmer_analytics():
+    if current_user.user_type != 'farmer':
+        flash('Only farmers can view sales analytics')
+        return redirect(url_for('market.dashboard'))
+    
+    days, window = analytics_args()
+    return render_template('farmer_analytics.html', sales=farmer_sales(current_user.id, days, window),
+                           days=days)
+
+@bp.route('/api/farmer_analytics')
+@query_budget(3)
+@login_required
+def api_farmer_analytics():
+    if current_user.user_type != 'farmer':
+        return jsonify({'success': False, 'message': 'Only farmers can view sales analytics'}), 403
+    
+    days, window = analytics_args()
+    return jsonify({'success': True, **farmer_sales(current_user.id, days, window)})
+
 # Farmer order details
-@app.route('/farmer_order_details/<int:order_id>')
+@bp.route('/farmer_order_details/<int:order_id>')
+@query_budget(3)
 @login_required
 def farmer_order_details(order_id):
     if current_user.user_type != 'farmer':
         flash('Only farmers can view order details')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('market.dashboard'))
     
-    order = Order.query.get_or_404(order_id)
+    order = Order.query.options(joinedload(Order.customer)).get_or_404(order_id)
     
     # Get only order items from this farmer
-    order_items = OrderItem.query.filter_by(order_id=order_id, farmer_id=current_user.id).all()
+    order_items = OrderItem.query.filter_by(order_id=order_id, farmer_id=current_user.id).\
+        options(joinedload(OrderItem.product)).\
+        all()
     
     if not order_items:
         flash('Order not found')
-        return redirect(url_for('farmer_orders'))
+        return redirect(url_for('market.farmer_orders'))
     
     return render_template('farmer_order_details.html', order=order, order_items=order_items)
 
-@app.route('/order_details/<int:order_id>')
+@bp.route('/order_details/<int:order_id>')
+@query_budget(4)
 @login_required
 def order_details(order_id):
     if current_user.user_type != 'customer':
         flash('Only customers can view order details')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('market.dashboard'))
     
     order = Order.query.get_or_404(order_id)
     
     # Verify the order belongs to the current customer
     if order.customer_id != current_user.id:
         flash('You can only view your own orders')
-        return redirect(url_for('orders'))
+        return redirect(url_for('market.orders'))
     
-    order_items = OrderItem.query.filter_by(order_id=order_id).all()
+    order_items = OrderItem.query.filter_by(order_id=order_id).\
+        options(joinedload(OrderItem.product).joinedload(Product.farmer)).\
+        all()
     
     return render_template('order_details.html', order=order, order_items=order_items)
 
 
 
 # Edit product
-@app.route('/edit_product/<int:product_id>', methods=['GET', 'POST'])
+@bp.route('/edit_product/<int:product_id>', methods=['GET', 'POST'])
 @login_required
 def edit_product(product_id):
     if current_user.user_type != 'farmer':
         flash('Only farmers can edit products')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('market.dashboard'))
     
     product = Product.query.filter_by(id=product_id, farmer_id=current_user.id).first()
     
     if not product:
         flash('Product not found or you do not have permission to edit it')
-        return redirect(url_for('my_products'))
+        return redirect(url_for('market.my_products'))
     
     if request.method == 'POST':
         product.name = request.form['name']
@@ -584,41 +2133,66 @@ def edit_product(product_id):
         product.quantity = int(request.form['quantity'])
         product.category = request.form['category']
         
+        image = request.files.get('image')
+        if image and image.filename:
+            try:
+                store_product_image(product, image)
+            except ValueError as e:
+                db.session.rollback()
+                flash(str(e))
+                return redirect(url_for('market.edit_product', product_id=product_id))
+        
+        index_products([product])
+        bump_catalog_version()
+        version = catalog_version()
         db.session.commit()
+        catalog_cache.invalidate()
+        suggest_index.add(product.id, product.name, product.category, product.quantity,
+                          product.rating.average if product.rating else 0)
+        suggest_index.advance(version)
         flash('Product updated successfully!')
-        return redirect(url_for('my_products'))
+        return redirect(url_for('market.my_products'))
     
     return render_template('edit_product.html', product=product)
 
 # Delete product
-@app.route('/delete_product/<int:product_id>', methods=['POST'])
+@bp.route('/delete_product/<int:product_id>', methods=['POST'])
 @login_required
 def delete_product(product_id):
     if current_user.user_type != 'farmer':
         flash('Only farmers can delete products')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('market.dashboard'))
     
     product = Product.query.filter_by(id=product_id, farmer_id=current_user.id).first()
     
     if not product:
         flash('Product not found or you do not have permission to delete it')
-        return redirect(url_for('my_products'))
+        return redirect(url_for('market.my_products'))
     
-    # Check if product has any orders
-    has_orders = OrderItem.query.filter_by(product_id=product_id).first()
+    # Check if product has any orders, archived ones included
+    has_orders = OrderItem.query.filter_by(product_id=product_id).first() or \
+        ArchivedOrderItem.query.filter_by(product_id=product_id).first()
     
     if has_orders:
         flash('Cannot delete product that has existing orders. You can set quantity to 0 instead.')
-        return redirect(url_for('my_products'))
+        return redirect(url_for('market.my_products'))
     
     # Delete product
+    unindex_product(product.id)
     db.session.delete(product)
+    bump_catalog_version()
+    version = catalog_version()
     db.session.commit()
+    catalog_cache.invalidate()
+    suggest_index.remove(product_id)
+    suggest_index.advance(version)
     flash('Product deleted successfully!')
-    return redirect(url_for('my_products'))
+    return redirect(url_for('market.my_products'))
 
 
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
         db.create_all()
+        create_missing_indexes()
     app.run(debug=True)
\ No newline at end of file
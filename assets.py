@@ -0,0 +1,167 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+# Text assets worth precompressing; images are already compressed
+COMPRESSIBLE = {'.css', '.js', '.json', '.map', '.svg', '.txt'}
+
+# Images that get resized modern-format copies for <picture> srcsets. The
+# source width is always included, so no size is ever upscaled.
+RESPONSIVE_IMAGES = {
+    'images/farm-hero.jpg': (320, 640),
+}
+IMAGE_FORMATS = (
+    ('avif', 'image/avif', {'quality': 55}),
+    ('webp', 'image/webp', {'quality': 80}),
+)
+
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def fingerprint(name, data):
+    stem, ext = os.path.splitext(name)
+    return f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+
+
+def _write(output_dir, name, data):
+    # Names carry a content hash, so an existing file already has these bytes
+    path = os.path.join(output_dir, name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+
+def _compressed(data):
+    variants = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data, quality=11)
+    # Tiny files can grow when compressed; serve those as they are
+    return {encoding: body for encoding, body in variants.items() if len(body) < len(data)}
+
+
+def _image_variants(name, data, output_dir):
+    source = Image.open(io.BytesIO(data))
+    source.load()
+    if source.mode not in ('RGB', 'RGBA'):
+        source = source.convert('RGBA' if 'A' in source.getbands() else 'RGB')
+
+    widths = sorted({width for width in RESPONSIVE_IMAGES[name] if width < source.width} | {source.width})
+    stem = os.path.splitext(name)[0]
+    variants = []
+    for extension, mimetype, options in IMAGE_FORMATS:
+        if not features.check(extension):
+            continue
+        for width in widths:
+            height = round(source.height * width / source.width)
+            image = source if width == source.width else source.resize((width, height), Image.LANCZOS)
+            buffer = io.BytesIO()
+            image.save(buffer, format=extension.upper(), **options)
+            path = fingerprint(f'{stem}-{width}w.{extension}', buffer.getvalue())
+            _write(output_dir, path, buffer.getvalue())
+            variants.append({'path': path, 'type': mimetype, 'width': width, 'size': len(buffer.getvalue())})
+    return variants
+
+
+def build_assets(static_folder, output_dir):
+    # Copy every static file to a content-hashed name under output_dir, with
+    # .gz/.br siblings for text assets, and write manifest.json mapping the
+    # original names to the hashed ones. Files from earlier builds are left in
+    # place so pages rendered before a deploy keep working.
+    manifest = {'files': {}, 'images': {}}
+    output_dir = os.path.abspath(output_dir)
+
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = sorted(d for d in dirs
+                         if not d.startswith('.') and os.path.abspath(os.path.join(root, d)) != output_dir)
+        for filename in sorted(files):
+            if filename.startswith('.'):
+                continue
+            source = os.path.join(root, filename)
+            name = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+
+            path = fingerprint(name, data)
+            _write(output_dir, path, data)
+            entry = {'path': path, 'size': len(data), 'encodings': {}}
+            if os.path.splitext(name)[1].lower() in COMPRESSIBLE:
+                for encoding, body in _compressed(data).items():
+                    suffix = dict(ENCODINGS)[encoding]
+                    _write(output_dir, path + suffix, body)
+                    entry['encodings'][encoding] = len(body)
+            manifest['files'][name] = entry
+
+            if name in RESPONSIVE_IMAGES and Image is not None:
+                manifest['images'][name] = _image_variants(name, data, output_dir)
+
+    path = os.path.join(output_dir, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+    return manifest
+
+
+class AssetManifest:
+    # Read side of build_assets(). The manifest is reloaded when the file
+    # changes, so a rebuild is picked up without restarting the server. With
+    # no manifest every lookup misses and callers fall back to the sources.
+
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        # (files, images, encodings), swapped as a whole on reload
+        self._state = ({}, {}, {})
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            with self._lock:
+                manifest = {}
+                if mtime is not None:
+                    with open(self.path) as f:
+                        manifest = json.load(f)
+                files = manifest.get('files', {})
+                images = manifest.get('images', {})
+                encodings = {entry['path']: [encoding for encoding, _ in ENCODINGS if encoding in entry['encodings']]
+                             for entry in files.values()}
+                encodings.update({variant['path']: [] for variants in images.values() for variant in variants})
+                self._state = ({name: entry['path'] for name, entry in files.items()}, images, encodings)
+                self._mtime = mtime
+        return self._state
+
+    @property
+    def version(self):
+        # Modification time of the manifest, None when there is no build
+        self._load()
+        return self._mtime
+
+    def lookup(self, name):
+        # Hashed path for a source name, or None
+        return self._load()[0].get(name)
+
+    def image_variants(self, name):
+        return self._load()[1].get(name, [])
+
+    def encodings(self, path):
+        # Precompressed encodings available for a hashed path, best first, or
+        # None when the path isn't part of the build
+        return self._load()[2].get(path)
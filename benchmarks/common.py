@@ -0,0 +1,50 @@
+"""Setup shared by the benchmark scripts.
+
+Importing this module puts the repository root first on sys.path, so the
+scripts can import the app however they are started.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def temp_database_url(name):
+    # A SQLite file in a new temporary directory
+    return 'sqlite:///' + os.path.join(tempfile.mkdtemp(), name)
+
+
+def make_app(name, **settings):
+    # The app on a throwaway database with every table created. DATABASE_URL
+    # is exported as well, so subprocesses and later create_app() calls use
+    # the same file.
+    os.environ['DATABASE_URL'] = temp_database_url(name)
+    from app import create_app
+    from models import db
+    app = create_app(settings)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def add_users(user_type, count, prefix=None):
+    # Users that are signed in with sign_in() rather than a password; call
+    # inside an app context and commit afterwards
+    from models import db, User
+    prefix = prefix or user_type
+    users = [User(username=f'{prefix}{i}', email=f'{prefix}{i}@example.com', password_hash='-',
+                  user_type=user_type) for i in range(count)]
+    db.session.add_all(users)
+    db.session.flush()
+    return users
+
+
+def sign_in(client, user_id, **extra):
+    # Sign a test client in without going through login(), so password
+    # hashing doesn't land on the measured requests
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+        session.update(extra)
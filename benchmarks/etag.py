@@ -0,0 +1,140 @@
+"""Check the conditional GET on catalog pages.
+
+Runs against a throwaway SQLite database:
+
+    python benchmarks/etag.py --requests 200
+
+Fails unless a repeat request for a product page is answered with a 304
+that renders no template and runs no query besides the catalog version
+lookup, another user's tag is refused, and a new review, a product edit, a
+new BUILD_ID, an asset rebuild, and the rebuild-search-index and
+backfill-ratings commands each change the tag. A second app on the same
+database stands in for another `serve` worker: after a product is added
+through one, the other must not answer the new tag with its cached
+category list.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from common import add_users, make_app, sign_in
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    asset_dir = tempfile.mkdtemp()
+    app = make_app('etag.db', ASSET_DIR=asset_dir)
+    from flask import template_rendered
+    from sqlalchemy import event
+    from app import create_app
+    from models import db, Product
+
+    with app.app_context():
+        farmer = add_users('farmer', 1)[0]
+        customers = add_users('customer', 2)
+        product = Product(name='Honeycrisp Apples', description='Crisp', price=4.5, quantity=50,
+                          category='Fruits', farmer_id=farmer.id)
+        db.session.add(product)
+        db.session.commit()
+        farmer_id, product_id = farmer.id, product.id
+        customer_ids = [customer.id for customer in customers]
+
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *rest: statements.append(statement))
+    templates = []
+    template_rendered.connect(lambda sender, template, context, **extra: templates.append(template.name), app)
+
+    clients = {}
+    for user_id in [farmer_id] + customer_ids:
+        clients[user_id] = app.test_client()
+        sign_in(clients[user_id], user_id, cart_units=0)
+    path = f'/product/{product_id}'
+
+    def get(user_id, etag=None):
+        del statements[:], templates[:]
+        headers = {'If-None-Match': f'"{etag}"'} if etag else {}
+        response = clients[user_id].get(path, headers=headers)
+        if response.status_code not in (200, 304):
+            sys.exit(f'FAILED: GET {path} returned {response.status_code}')
+        return response.status_code, response.get_etag()[0]
+
+    def post(user_id, url, data):
+        response = clients[user_id].post(url, data=data)
+        if response.status_code != 302:
+            sys.exit(f'FAILED: POST {url} returned {response.status_code}')
+        # Render the flash message, so later requests can be answered with 304
+        clients[user_id].get(response.location)
+
+    def write_manifest():
+        with open(os.path.join(asset_dir, 'manifest.json'), 'w') as f:
+            json.dump({'files': {}, 'images': {}}, f)
+
+    problems = []
+    customer, other = customer_ids
+    status, etag = get(customer)
+    if status != 200:
+        problems.append(f'the first request returned {status}')
+
+    started = time.perf_counter()
+    for _ in range(args.requests):
+        status, _ = get(customer, etag)
+        if status != 304:
+            problems.append(f'a repeat request returned {status}')
+            break
+        if templates:
+            problems.append(f'a 304 rendered {", ".join(templates)}')
+            break
+        if len(statements) != 1 or 'catalog_version' not in statements[0]:
+            problems.append(f'a 304 ran {len(statements)} statements: {statements}')
+            break
+    elapsed = time.perf_counter() - started
+
+    status, _ = get(other, etag)
+    if status != 200:
+        problems.append(f"another user's tag got a {status}")
+
+    changes = [
+        ('a new review', lambda: post(other, f'/add_review/{product_id}', {'rating': '5', 'comment': 'Great'})),
+        ('a product edit', lambda: post(farmer_id, f'/edit_product/{product_id}', {
+            'name': 'Honeycrisp Apples', 'description': 'Crisp', 'price': '4.0', 'quantity': '50',
+            'category': 'Fruits'})),
+        ('a new BUILD_ID', lambda: app.config.update(BUILD_ID='next-release')),
+        ('an asset rebuild', write_manifest),
+        ('rebuild-search-index', lambda: app.test_cli_runner().invoke(args=['rebuild-search-index'])),
+        ('backfill-ratings', lambda: app.test_cli_runner().invoke(args=['backfill-ratings'])),
+    ]
+    for label, change in changes:
+        change()
+        status, new_etag = get(customer, etag)
+        if status != 200 or new_etag == etag:
+            problems.append(f'{label} did not change the tag')
+        etag = new_etag
+
+    # Another worker fills its catalog cache, then a product in a new
+    # category is added through this one
+    worker = create_app({'ASSET_DIR': asset_dir})
+    shopper = worker.test_client()
+    sign_in(shopper, customer, cart_units=0)
+    shopper.get('/marketplace')
+    post(farmer_id, '/add_product', {'name': 'Chanterelles', 'description': 'Wild', 'price': '12',
+                                     'quantity': '5', 'category': 'Mushrooms'})
+    response = shopper.get('/marketplace')
+    if b'Mushrooms' not in response.data:
+        problems.append('another worker rendered its cached categories under the new tag')
+
+    print(f'{args.requests} repeat requests answered with 304 in {elapsed:.3f}s '
+          f'({elapsed / args.requests * 1000:.2f} ms each)')
+    if problems:
+        sys.exit('FAILED: ' + '; '.join(problems))
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
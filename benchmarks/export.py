@@ -0,0 +1,80 @@
+"""Check that the farmer order CSV export streams in constant memory.
+
+Seeds a throwaway SQLite database where one farmer sold everything, then
+downloads /farmer_orders/export for growing date ranges:
+
+    python benchmarks/export.py --orders 40000
+
+Peak Python memory (tracemalloc) is measured while the response is read
+chunk by chunk, and compared with loading the same rows with .all(). The
+run fails if the streamed peak grows with the export size.
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from common import make_app, sign_in
+
+
+def measure(fn):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=40000)
+    parser.add_argument('--days', type=int, default=360)
+    parser.add_argument('--archive-days', type=int, default=90, help='archive orders older than this first')
+    args = parser.parse_args()
+
+    app = make_app('export.db')
+    from app import archive_orders, farmer_export_query, seed_database
+    from models import db
+
+    with app.app_context():
+        seed_database(1, 500, 2000, reviews=0, carts=0, orders=args.orders, days=args.days)
+        db.session.commit()
+        archived, _ = archive_orders(args.archive_days, batch_size=5000)
+        print(f'{args.orders} orders, {archived} of them archived')
+
+    client = app.test_client()
+    sign_in(client, 1)
+
+    def stream(start):
+        response = client.get('/farmer_orders/export', query_string={'start': start.strftime('%Y-%m-%d')},
+                              buffered=False)
+        lines = sum(chunk.count(b'\n') for chunk in response.response)
+        response.close()
+        return lines - 1
+
+    def load_all(start):
+        with app.app_context():
+            return len(db.session.execute(farmer_export_query(1, start)).all())
+
+    today = datetime.utcnow()
+    print(f'{"days":>6}{"rows":>9}{"stream s":>10}{"stream MB":>11}{"all() MB":>10}')
+    peaks = []
+    for days in (args.days // 8, args.days // 4, args.days // 2, args.days):
+        start = today - timedelta(days=days)
+        rows, elapsed, peak = measure(lambda: stream(start))
+        _, _, naive_peak = measure(lambda: load_all(start))
+        peaks.append(peak)
+        print(f'{days:>6}{rows:>9}{elapsed:>10.2f}{peak:>11.2f}{naive_peak:>10.2f}')
+
+    # Allow some noise, but an export eight times larger must not need
+    # anywhere near eight times the memory
+    if peaks[-1] > 2 * peaks[0] + 1:
+        sys.exit(f'FAILED: streaming peak grew from {peaks[0]:.2f} MB to {peaks[-1]:.2f} MB')
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""Check that /metrics adds up across `flask serve` worker processes.
+
+Seeds a throwaway SQLite database, starts `flask serve` with several
+workers and sends a known number of requests to /product/<id> and
+/marketplace from separate connections:
+
+    python benchmarks/metrics.py --workers 4 --requests 2000
+
+Then scrapes /metrics repeatedly, each time on a new connection so different
+workers answer, and fails unless every scrape reports exactly the requests
+that were sent. Also times MetricsRegistry.observe() from one and several
+threads, and rendering a scrape, and fails if a threaded server keeps a
+metrics shard for every connection it has served.
+"""
+import argparse
+import http.client
+import logging
+import multiprocessing
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from common import ROOT, make_app, temp_database_url
+
+READY = re.compile(r'Worker (\d+) ready')
+COUNT = re.compile(r'^http_request_duration_seconds_count\{endpoint="([^"]+)",method="GET",status="200"\} (\d+)$',
+                   re.MULTILINE)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def client(port, products, requests, seed):
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    sent = {'market.product_details': 0, 'market.marketplace': 0}
+    for _ in range(requests):
+        if rng.random() < 0.5:
+            path, endpoint = f'/product/{rng.randint(1, products)}', 'market.product_details'
+        else:
+            path, endpoint = f'/marketplace?page={rng.randint(1, 5)}', 'market.marketplace'
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            sys.exit(f'FAILED: {path} returned {response.status}')
+        sent[endpoint] += 1
+    connection.close()
+    return sent
+
+
+def scrape(port):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    connection.request('GET', '/metrics')
+    response = connection.getresponse()
+    body = response.read().decode()
+    connection.close()
+    return dict((endpoint, int(count)) for endpoint, count in COUNT.findall(body))
+
+
+def time_observe(threads, calls):
+    from metrics import LATENCY_BUCKETS, MetricsRegistry
+    registry = MetricsRegistry()
+    registry.histogram('bench_seconds', 'Benchmark.', ['endpoint'], LATENCY_BUCKETS)
+
+    def record():
+        for n in range(calls):
+            registry.observe('bench_seconds', ('market.index',), (n % 100) / 1000)
+
+    workers = [threading.Thread(target=record) for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    if registry.collect()['bench_seconds', ('market.index',)][-1] != threads * calls:
+        sys.exit(f'FAILED: lost observations with {threads} threads')
+    return elapsed / (threads * calls) * 1e9, registry
+
+
+def check_shards(connections):
+    # werkzeug's threaded server starts a thread per connection; the shards
+    # of finished threads must be folded away rather than kept
+    from werkzeug.serving import make_server
+    app = make_app('shards.db')
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    for _ in range(connections):
+        connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=10)
+        connection.request('GET', '/about')
+        connection.getresponse().read()
+        connection.close()
+
+    registry = app.extensions['metrics']
+    deadline = time.monotonic() + 5
+    while registry.shard_count() > 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    server.shutdown()
+    counted = registry.collect().get(('http_request_duration_seconds', ('market.about', 'GET', '200')), [0])[-1]
+    if counted != connections:
+        sys.exit(f'FAILED: {counted} of {connections} requests counted')
+    if registry.shard_count() > 2:
+        sys.exit(f'FAILED: {registry.shard_count()} shards left after {connections} connections')
+    return registry.shard_count()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 2))
+    parser.add_argument('--clients', type=int, default=8, help='concurrent keep-alive connections')
+    parser.add_argument('--requests', type=int, default=2000, help='total requests to send')
+    parser.add_argument('--scrapes', type=int, default=10)
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--connections', type=int, default=300, help='connections for the shard check')
+    args = parser.parse_args()
+
+    for threads in (1, 4):
+        ns, registry = time_observe(threads, 200000 // threads)
+        print(f'observe() from {threads} thread(s): {ns:.0f} ns per call')
+    started = time.perf_counter()
+    registry.render()
+    print(f'render(): {(time.perf_counter() - started) * 1000:.2f} ms')
+    print(f'{check_shards(args.connections)} metrics shards left after {args.connections} connections')
+
+    env = dict(os.environ, DATABASE_URL=temp_database_url('metrics.db'), DB_PROFILE='production')
+    env.pop('METRICS_DIR', None)
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'seed-data', '--farmers', '10',
+                    '--customers', '50', '--products', str(args.products), '--reviews', str(args.products * 2),
+                    '--orders', '500'], cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+
+    port = free_port()
+    server = subprocess.Popen([sys.executable, '-m', 'flask', '--app', 'app', 'serve', '--bind', f'127.0.0.1:{port}',
+                               '--workers', str(args.workers)], cwd=ROOT, env=env, stderr=subprocess.PIPE, text=True)
+    try:
+        ready = 0
+        for line in server.stderr:
+            if READY.search(line):
+                ready += 1
+                if ready == args.workers:
+                    break
+        else:
+            sys.exit(f'FAILED: server exited with status {server.wait()}')
+        threading.Thread(target=lambda: [None for _ in server.stderr], daemon=True).start()
+
+        per_client = args.requests // args.clients
+        with multiprocessing.get_context('fork').Pool(args.clients) as pool:
+            results = pool.starmap(client, [(port, args.products, per_client, n) for n in range(args.clients)])
+        sent = {endpoint: sum(result[endpoint] for result in results) for endpoint in results[0]}
+        print(f'sent {sent} to {args.workers} workers')
+
+        # Workers write their totals about once a second
+        time.sleep(2.5)
+        failed = False
+        for _ in range(args.scrapes):
+            counts = scrape(port)
+            reported = {endpoint: counts.get(endpoint, 0) for endpoint in sent}
+            if reported != sent:
+                print(f'scrape reported {reported}')
+                failed = True
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+
+    if failed:
+        sys.exit('FAILED: scraped request counts differ from the requests sent')
+    print(f'{args.scrapes} scrapes all matched')
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
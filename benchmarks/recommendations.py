@@ -0,0 +1,115 @@
+"""Time the frequently-bought-together rebuild and lookup against a SQL self-join.
+
+Seeds a throwaway SQLite database, then:
+
+    python benchmarks/recommendations.py --orders 20000 --checkouts 200
+
+- times rebuild_recommendations() (sparse matrix product) against one
+  GROUP BY self-join over order_item computing the same pair counts
+- times the product page lookup against running the self-join for one
+  product, as a request-time implementation would, for products drawn in
+  proportion to their sales
+- places --checkouts orders through checkout and fails unless the
+  incrementally maintained tables match a full rebuild
+"""
+import argparse
+import random
+import statistics
+import sys
+import time
+
+from common import make_app, sign_in
+
+SELF_JOIN = '''
+    SELECT a.product_id, b.product_id, count(*)
+    FROM order_item a JOIN order_item b ON a.order_id = b.order_id AND a.product_id != b.product_id
+    {where}
+    GROUP BY a.product_id, b.product_id
+'''
+
+# What the product page needs: the top in-stock co-purchased products
+LOOKUP = '''
+    SELECT product.* FROM recommendation JOIN product ON product.id = recommendation.recommended_id
+    WHERE recommendation.product_id = :id AND product.quantity > 0
+    ORDER BY recommendation.rank LIMIT 4
+'''
+ADHOC = '''
+    SELECT product.* FROM order_item a
+    JOIN order_item b ON a.order_id = b.order_id AND a.product_id != b.product_id
+    JOIN product ON product.id = b.product_id
+    WHERE a.product_id = :id AND product.quantity > 0
+    GROUP BY b.product_id ORDER BY count(*) DESC, b.product_id LIMIT 4
+'''
+
+
+def timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--orders', type=int, default=20000)
+    parser.add_argument('--checkouts', type=int, default=200)
+    parser.add_argument('--lookups', type=int, default=500)
+    args = parser.parse_args()
+
+    app = make_app('recommendations.db')
+    from sqlalchemy import text
+    from app import rebuild_recommendations, seed_database
+    from models import db, CoPurchase, Product, Recommendation
+
+    def snapshot():
+        return (sorted(db.session.query(CoPurchase.product_id, CoPurchase.other_id, CoPurchase.order_count)),
+                sorted(db.session.query(Recommendation.product_id, Recommendation.rank,
+                                        Recommendation.recommended_id, Recommendation.order_count)))
+
+    rng = random.Random(42)
+    with app.app_context():
+        seed_database(50, 500, args.products, reviews=0, carts=0, orders=args.orders)
+        db.session.commit()
+
+        products, rebuild_ms = timed(rebuild_recommendations)
+        db.session.commit()
+        pairs = db.session.query(CoPurchase).count()
+        _, join_ms = timed(lambda: db.session.execute(text(SELF_JOIN.format(where=''))).all())
+        print(f'full rebuild: {rebuild_ms:.0f} ms for {pairs} pairs over {products} products '
+              f'(counting the pairs with a self-join alone: {join_ms:.0f} ms)')
+
+        # Page views follow sales, so popular products (the expensive ones
+        # for a self-join) come up as often as they would in real traffic
+        product_ids = [product_id for (product_id,) in db.session.execute(
+            text('SELECT product_id FROM order_item ORDER BY random() LIMIT :n'), {'n': args.lookups})]
+        for name, sql in (('lookup table', LOOKUP), ('request-time self-join', ADHOC)):
+            samples = [timed(lambda: db.session.execute(text(sql), {'id': product_id}).all())[1]
+                       for product_id in product_ids]
+            print(f'product page {name}: median {statistics.median(samples):.3f} ms, '
+                  f'p99 {sorted(samples)[int(len(samples) * 0.99)]:.3f} ms')
+        in_stock = [product_id for (product_id,) in db.session.query(Product.id).filter(Product.quantity > 50)]
+
+    client = app.test_client()
+    sign_in(client, 51)
+    checkout_ms = []
+    for _ in range(args.checkouts):
+        client.post('/api/cart', json={'changes': [{'product_id': product_id, 'op': 'increment'}
+                                                   for product_id in rng.sample(in_stock, rng.randint(1, 5))]})
+        started = time.perf_counter()
+        response = client.post('/checkout')
+        checkout_ms.append((time.perf_counter() - started) * 1000)
+        if response.status_code != 302:
+            sys.exit(f'FAILED: checkout returned {response.status_code}')
+    print(f'checkout with incremental update: median {statistics.median(checkout_ms):.2f} ms')
+
+    with app.app_context():
+        incremental = snapshot()
+        rebuild_recommendations()
+        db.session.commit()
+        if snapshot() != incremental:
+            sys.exit('FAILED: incremental recommendations differ from a full rebuild')
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
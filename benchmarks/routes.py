@@ -0,0 +1,255 @@
+"""Replay a traffic mix against a seeded market and report latency and queries per route.
+
+Seeds a throwaway SQLite database with `seed_database()` and drives the
+Flask test client with a fixed-seed mix of shoppers and farmers:
+
+    python benchmarks/routes.py --requests 2000
+    python benchmarks/routes.py --save-baseline       # record benchmarks/baseline.json
+    python benchmarks/routes.py --tolerance 0.5       # allow p95 to grow 50% before failing
+    python benchmarks/routes.py --archive-days 30     # archive old orders before measuring
+
+Each route's p50/p95/p99 latency and its mean and worst SQL statement count
+(from the X-Query-Count header) are compared with the baseline. The run
+fails if a route's p95 grows by more than the tolerance or its worst query
+count goes up at all. Latency baselines only mean something on the machine
+that recorded them; query counts hold everywhere.
+
+Views run with QUERY_BUDGET_STRICT, so any request (warmup included) that
+issues more statements than its @query_budget fails the run. Half the
+signed in shoppers start without a cart badge count in their session, as
+after a remember-me login, so the lazy badge query is covered too.
+
+Every distinct SQL statement the views issue is recorded through
+query_stats.on_statement(). After the timed replay, one untimed pass visits
+the remaining pages (dashboards, order history, reviews, exports and the
+JSON APIs) under the same strict budgets, then every recorded statement is
+run through EXPLAIN QUERY PLAN. The run fails if any of them reads a whole
+table, so schema or query changes that lose an index show up here.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+from common import make_app, sign_in
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Share of requests per route
+TRAFFIC_MIX = {
+    'marketplace': 35,
+    'product': 30,
+    'cart': 15,
+    'checkout': 5,
+    'farmer_orders': 15,
+}
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=100, help='requests replayed before measuring')
+    parser.add_argument('--farmers', type=int, default=50)
+    parser.add_argument('--customers', type=int, default=1000)
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--reviews', type=int, default=20000)
+    parser.add_argument('--orders', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--archive-days', type=int, help='run archive_orders() with this age after seeding')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='write this run as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative p95 increase')
+    args = parser.parse_args()
+
+    # Strict budgets turn a view going over its @query_budget into a 500,
+    # which fails the run like any other error
+    app = make_app('routes.db', QUERY_STATS_HEADER=True, QUERY_BUDGET_STRICT=True)
+    from flask import has_request_context, request
+    from app import archive_orders, cart_summary, full_table_scans, seed_database
+    from models import db, Order, OrderItem, Product
+    from query_stats import on_statement
+
+    # The first parameters seen for each distinct statement, with its endpoint
+    statements = {}
+
+    @on_statement
+    def record_statement(statement, parameters, elapsed):
+        if has_request_context() and statement not in statements:
+            statements[statement] = (request.endpoint, parameters)
+
+    with app.app_context():
+        seed_database(args.farmers, args.customers, args.products, args.reviews,
+                      carts=args.customers // 3, orders=args.orders, seed=args.seed)
+        db.session.commit()
+        if args.archive_days is not None:
+            archived, _ = archive_orders(args.archive_days, batch_size=1000)
+            print(f'Archived {archived} of {args.orders} orders')
+        in_stock = [product_id for (product_id,) in db.session.query(Product.id).filter(Product.quantity > 0)]
+        categories = [category for (category,) in db.session.query(Product.category).distinct()]
+        order = db.session.query(Order).order_by(Order.id.desc()).first()
+        farmer_id = db.session.query(OrderItem.farmer_id).filter_by(order_id=order.id).limit(1).scalar()
+        order_id, order_customer_id = order.id, order.customer_id
+
+    farmer_ids = range(1, args.farmers + 1)
+    customer_ids = range(args.farmers + 1, args.farmers + args.customers + 1)
+    rng = random.Random(args.seed)
+    clients = {}
+
+    def client_for(user_id):
+        # One client (and session cookie) per user, signed in without the
+        # password hash so that cost doesn't land on the measured requests
+        if user_id not in clients:
+            client = app.test_client()
+            if user_id in customer_ids and user_id % 2:
+                # login() stores the cart badge count as well
+                with app.app_context():
+                    sign_in(client, user_id, cart_units=cart_summary(user_id)['units'])
+            elif user_id is not None:
+                # Like a remember-me cookie or a session from before a deploy,
+                # with no cart badge count yet
+                sign_in(client, user_id)
+            clients[user_id] = client
+        return clients[user_id]
+
+    def next_request():
+        route = rng.choices(list(TRAFFIC_MIX), weights=list(TRAFFIC_MIX.values()))[0]
+        if route == 'marketplace':
+            user_id = rng.choice([None, rng.choice(customer_ids)])
+            params = rng.choice([{}, {'category': rng.choice(categories)},
+                                 {'search': rng.choice(['tom', 'fresh apples', 'honey'])}])
+            return route, client_for(user_id), 'get', '/marketplace', params, None
+        if route == 'product':
+            user_id = rng.choice([None, rng.choice(customer_ids)])
+            return route, client_for(user_id), 'get', f'/product/{rng.randint(1, args.products)}', {}, None
+        if route == 'cart':
+            return route, client_for(rng.choice(customer_ids)), 'get', '/cart', {}, None
+        if route == 'checkout':
+            # Put something in the cart first; only the checkout is timed
+            client = client_for(rng.choice(customer_ids))
+            setup = ('/api/cart', {'changes': [{'product_id': rng.choice(in_stock), 'op': 'increment'}]})
+            return route, client, 'post', '/checkout', {}, setup
+        return route, client_for(rng.choice(farmer_ids)), 'get', '/farmer_orders', {}, None
+
+    results = {route: {'latency': [], 'queries': [], 'errors': 0} for route in TRAFFIC_MIX}
+    for n in range(args.warmup + args.requests):
+        route, client, method, path, params, setup = next_request()
+        if setup:
+            client.post(setup[0], json=setup[1])
+        started = time.perf_counter()
+        response = getattr(client, method)(path, query_string=params)
+        elapsed = (time.perf_counter() - started) * 1000
+        result = results[route]
+        if response.status_code >= 400:
+            # Counted during warmup too: cold caches are where budgets overrun
+            result['errors'] += 1
+            continue
+        if n < args.warmup:
+            continue
+        result['latency'].append(elapsed)
+        result['queries'].append(int(response.headers.get('X-Query-Count', 0)))
+
+    # Pages outside the timed mix, visited once so their statements are
+    # checked too. Run after the replay so it isn't skewed by them.
+    product_id = in_stock[0]
+    coverage = [
+        (None, 'get', '/', None),
+        (None, 'get', '/api/products', None),
+        (None, 'get', '/api/suggest?q=app', None),
+        (order_customer_id, 'get', '/dashboard', None),
+        (order_customer_id, 'get', '/orders', None),
+        (order_customer_id, 'get', '/order_history', None),
+        (order_customer_id, 'get', f'/order_details/{order_id}', None),
+        (order_customer_id, 'get', f'/add_review/{product_id}', None),
+        (order_customer_id, 'post', '/api/cart', {'changes': [{'product_id': product_id, 'op': 'set', 'quantity': 2}]}),
+        (order_customer_id, 'post', '/api/cart', {'changes': [{'product_id': product_id, 'op': 'remove'}]}),
+        (farmer_id, 'get', '/dashboard', None),
+        (farmer_id, 'get', '/my_products', None),
+        (farmer_id, 'get', '/farmer_reviews', None),
+        (farmer_id, 'get', '/farmer_analytics', None),
+        (farmer_id, 'get', '/api/farmer_analytics', None),
+        (farmer_id, 'get', '/order_history', None),
+        (farmer_id, 'get', f'/farmer_order_details/{order_id}', None),
+        (farmer_id, 'get', '/farmer_orders/export', None),
+        (farmer_id, 'post', '/api/orders/status', {'order_ids': [order_id], 'status': 'shipped'}),
+    ]
+    coverage_errors = []
+    for user_id, method, path, payload in coverage:
+        response = getattr(client_for(user_id), method)(path, json=payload)
+        if response.status_code >= 400:
+            coverage_errors.append(f'{method.upper()} {path} returned {response.status_code}')
+
+    # Only reads, updates and deletes can scan; inserts and transaction
+    # control have nothing to check
+    scans = []
+    with app.app_context():
+        for statement, (endpoint, parameters) in statements.items():
+            if not re.match(r'\s*(SELECT|WITH|UPDATE|DELETE)\b', statement, re.IGNORECASE):
+                continue
+            if isinstance(parameters, list):
+                # executemany; the plan is the same for every row
+                parameters = parameters[0]
+            for scan in full_table_scans(statement, parameters):
+                scans.append(f'{endpoint}: {scan} in {" ".join(statement.split())[:200]}')
+
+    report = {}
+    for route, result in results.items():
+        if not result['latency']:
+            continue
+        report[route] = {
+            'requests': len(result['latency']),
+            'errors': result['errors'],
+            'p50_ms': round(percentile(result['latency'], 50), 2),
+            'p95_ms': round(percentile(result['latency'], 95), 2),
+            'p99_ms': round(percentile(result['latency'], 99), 2),
+            'queries_mean': round(sum(result['queries']) / len(result['queries']), 2),
+            'queries_max': max(result['queries']),
+        }
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['routes']
+
+    print(f'{"route":<15}{"n":>6}{"err":>5}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"queries":>9}{"max":>5}  vs baseline')
+    regressions = []
+    for route, stats in report.items():
+        line = (f'{route:<15}{stats["requests"]:>6}{stats["errors"]:>5}{stats["p50_ms"]:>9.2f}{stats["p95_ms"]:>9.2f}'
+                f'{stats["p99_ms"]:>9.2f}{stats["queries_mean"]:>9.2f}{stats["queries_max"]:>5}')
+        before = baseline.get(route)
+        if before:
+            change = stats['p95_ms'] / before['p95_ms'] - 1 if before['p95_ms'] else 0
+            line += f'  p95 {change:+.0%}, max queries {before["queries_max"]} -> {stats["queries_max"]}'
+            if change > args.tolerance:
+                regressions.append(f'{route} p95 {before["p95_ms"]} -> {stats["p95_ms"]} ms')
+            if stats['queries_max'] > before['queries_max']:
+                regressions.append(f'{route} max queries {before["queries_max"]} -> {stats["queries_max"]}')
+        if stats['errors']:
+            regressions.append(f'{route} returned {stats["errors"]} errors')
+        print(line)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'requests': args.requests, 'seed': args.seed, 'routes': report}, f, indent=2)
+            f.write('\n')
+        print(f'Saved baseline to {args.baseline}')
+    print(f'Checked the query plans of {len(statements)} distinct statements')
+    for scan in scans:
+        print(f'full table scan, {scan}')
+    regressions.extend(coverage_errors)
+    if scans:
+        regressions.append(f'{len(scans)} statements read whole tables')
+    if regressions:
+        sys.exit('REGRESSED: ' + '; '.join(regressions))
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
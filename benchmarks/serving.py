@@ -0,0 +1,156 @@
+"""Compare startup time, memory and throughput of the preforking `serve` command.
+
+Seeds a throwaway SQLite database with `flask seed-data`, then starts
+`flask serve` three ways and drives each with the same HTTP load:
+one worker, N preloaded workers and N workers that each build the app
+after forking.
+
+    python benchmarks/serving.py --workers 4 --seconds 10 --clients 16
+
+Also reports how long a cold `create_app()` takes in a fresh interpreter.
+Worker memory is the proportional set size (pages shared copy-on-write are
+split between the processes sharing them) and is only available on Linux.
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import random
+import re
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from common import ROOT, temp_database_url
+
+COLD_START = ('import time; started = time.perf_counter(); from app import create_app; create_app(); '
+              'print(time.perf_counter() - started)')
+READY = re.compile(r'Worker (\d+) ready in (\d+) ms')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def pss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def client(port, products, deadline, seed):
+    # Runs in its own process so the load generator isn't held back by the GIL
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    done = errors = 0
+    while time.monotonic() < deadline:
+        if rng.random() < 0.5:
+            path = f'/product/{rng.randint(1, products)}'
+        else:
+            path = f'/marketplace?page={rng.randint(1, 5)}'
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 400:
+                errors += 1
+            else:
+                done += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    connection.close()
+    return done, errors
+
+
+def run_server(args, env, workers, preload):
+    port = free_port()
+    command = [sys.executable, '-m', 'flask', '--app', 'app', 'serve', '--bind', f'127.0.0.1:{port}',
+               '--workers', str(workers), '--preload' if preload else '--no-preload']
+    started = time.perf_counter()
+    server = subprocess.Popen(command, cwd=ROOT, env=env, stderr=subprocess.PIPE, text=True)
+    try:
+        pids, boot_ms = [], []
+        for line in server.stderr:
+            match = READY.search(line)
+            if match:
+                pids.append(int(match.group(1)))
+                boot_ms.append(int(match.group(2)))
+                if len(pids) == workers:
+                    break
+        else:
+            sys.exit(f'FAILED: server exited with status {server.wait()}')
+        startup = time.perf_counter() - started
+        # Keep reading so the server never blocks on a full pipe
+        threading.Thread(target=lambda: [None for _ in server.stderr], daemon=True).start()
+
+        deadline = time.monotonic() + args.warmup
+        with multiprocessing.get_context('fork').Pool(args.clients) as pool:
+            pool.starmap(client, [(port, args.products, deadline, n) for n in range(args.clients)])
+            deadline = time.monotonic() + args.seconds
+            results = pool.starmap(client, [(port, args.products, deadline, n) for n in range(args.clients)])
+
+        memory = [pss_kb(pid) for pid in [server.pid] + pids]
+        return {
+            'startup': startup,
+            'worker_ms': max(boot_ms),
+            'pss_mb': sum(memory) / 1024 if None not in memory else None,
+            'rps': sum(done for done, _ in results) / args.seconds,
+            'errors': sum(errors for _, errors in results),
+        }
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 2))
+    parser.add_argument('--clients', type=int, default=16, help='concurrent keep-alive connections')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--cold-starts', type=int, default=5)
+    parser.add_argument('--products', type=int, default=2000)
+    args = parser.parse_args()
+
+    env = dict(os.environ,
+               DATABASE_URL=temp_database_url('serving.db'),
+               DB_PROFILE='production')
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'seed-data', '--farmers', '20',
+                    '--customers', '200', '--products', str(args.products), '--reviews', str(args.products * 4),
+                    '--orders', '2000'], cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+
+    cold = [float(subprocess.run([sys.executable, '-c', COLD_START], cwd=ROOT, env=env, check=True,
+                                 capture_output=True, text=True).stdout)
+            for _ in range(args.cold_starts)]
+    print(f'cold import + create_app(): median {statistics.median(cold) * 1000:.0f} ms '
+          f'over {args.cold_starts} fresh interpreters')
+
+    runs = [(1, True), (args.workers, True), (args.workers, False)]
+    print(f'{"workers":>8}{"preload":>9}{"startup s":>11}{"worker ms":>11}{"PSS MB":>9}{"req/s":>9}{"errors":>8}')
+    failed = False
+    for workers, preload in runs:
+        result = run_server(args, env, workers, preload)
+        pss = f'{result["pss_mb"]:.1f}' if result['pss_mb'] is not None else '-'
+        print(f'{workers:>8}{"yes" if preload else "no":>9}{result["startup"]:>11.2f}{result["worker_ms"]:>11}'
+              f'{pss:>9}{result["rps"]:>9.0f}{result["errors"]:>8}')
+        failed = failed or result['errors'] > 0
+
+    if failed:
+        sys.exit('FAILED: some requests returned errors')
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
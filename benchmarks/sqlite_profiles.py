@@ -0,0 +1,105 @@
+"""Compare read throughput under concurrent writes for each SQLite engine profile.
+
+Every profile runs in its own process against a fresh throwaway database:
+readers browse /marketplace and product pages while writers add to cart and
+check out.
+
+    python benchmarks/sqlite_profiles.py --seconds 10 --readers 8 --writers 4
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from common import add_users, make_app, sign_in
+
+
+def run_profile(args):
+    app = make_app('bench.db')
+    from models import db, Product
+
+    with app.app_context():
+        farmer = add_users('farmer', 1)[0]
+        db.session.add_all([Product(name=f'Product {i}', description='Fresh from the farm', price=2.5,
+                                    quantity=10 ** 9, category=f'Category {i % 8}', farmer_id=farmer.id)
+                            for i in range(args.products)])
+        customers = add_users('customer', args.writers, prefix='buyer')
+        db.session.commit()
+        customer_ids = [customer.id for customer in customers]
+
+    deadline = time.perf_counter() + args.seconds
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+
+    def tally(key):
+        with lock:
+            counts[key] += 1
+
+    def reader(n):
+        client = app.test_client()
+        i = n
+        while time.perf_counter() < deadline:
+            url = '/marketplace' if i % 2 else f'/product/{i % args.products + 1}'
+            response = client.get(url)
+            tally('reads' if response.status_code == 200 else 'errors')
+            i += 1
+
+    def writer(customer_id):
+        client = app.test_client()
+        sign_in(client, customer_id)
+        i = customer_id
+        while time.perf_counter() < deadline:
+            added = client.post(f'/add_to_cart/{i % args.products + 1}', data={'quantity': '1'})
+            placed = client.post('/checkout')
+            ok = added.status_code == 200 and placed.headers.get('Location', '').endswith('/orders')
+            tally('writes' if ok else 'errors')
+            i += 1
+
+    threads = [threading.Thread(target=reader, args=(n,)) for n in range(args.readers)]
+    threads += [threading.Thread(target=writer, args=(customer_id,)) for customer_id in customer_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(json.dumps({
+        'profile': app.config['DB_PROFILE'],
+        'reads_per_sec': counts['reads'] / args.seconds,
+        'writes_per_sec': counts['writes'] / args.seconds,
+        'errors': counts['errors'],
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--profiles', default='development,production')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        return run_profile(args)
+
+    results = []
+    for profile in args.profiles.split(','):
+        command = [sys.executable, __file__, '--run', profile, '--seconds', str(args.seconds),
+                   '--readers', str(args.readers), '--writers', str(args.writers),
+                   '--products', str(args.products)]
+        output = subprocess.run(command, env=dict(os.environ, DB_PROFILE=profile),
+                                capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f'{"profile":<14}{"reads/s":>10}{"writes/s":>10}{"errors":>8}')
+    for result in results:
+        print(f'{result["profile"]:<14}{result["reads_per_sec"]:>10.1f}'
+              f'{result["writes_per_sec"]:>10.1f}{result["errors"]:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Fire simultaneous checkouts at a small stock and check nothing is oversold.
+
+Runs against a throwaway SQLite database:
+
+    python benchmarks/stress_checkout.py --buyers 300 --stock 40
+"""
+import argparse
+import sys
+import threading
+import time
+
+from common import add_users, make_app, sign_in
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--buyers', type=int, default=300)
+    parser.add_argument('--stock', type=int, default=40)
+    parser.add_argument('--per-buyer', type=int, default=1, help='units each buyer has in their cart')
+    args = parser.parse_args()
+
+    app = make_app('stress.db')
+    from models import db, Product, Cart, Order, OrderItem
+
+    with app.app_context():
+        farmer = add_users('farmer', 1)[0]
+        product = Product(name='Heirloom Tomatoes', price=4.5, quantity=args.stock,
+                          category='Vegetables', farmer_id=farmer.id)
+        customers = add_users('customer', args.buyers, prefix='buyer')
+        db.session.add(product)
+        db.session.flush()
+        db.session.add_all([Cart(customer_id=customer.id, product_id=product.id, quantity=args.per_buyer)
+                            for customer in customers])
+        db.session.commit()
+        product_id = product.id
+        customer_ids = [customer.id for customer in customers]
+
+    start = threading.Barrier(len(customer_ids))
+    outcomes = []
+
+    def buy(customer_id):
+        client = app.test_client()
+        sign_in(client, customer_id)
+        start.wait()
+        response = client.post('/checkout')
+        outcomes.append(response.headers.get('Location', ''))
+
+    threads = [threading.Thread(target=buy, args=(customer_id,)) for customer_id in customer_ids]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        remaining = db.session.get(Product, product_id).quantity
+        sold = db.session.query(db.func.coalesce(db.func.sum(OrderItem.quantity), 0)).scalar()
+        orders = Order.query.count()
+        orphaned = Order.query.outerjoin(OrderItem).filter(OrderItem.id.is_(None)).count()
+
+    placed = sum(1 for location in outcomes if location.endswith('/orders'))
+    print(f'{len(customer_ids)} checkouts in {elapsed:.2f}s: {placed} placed, '
+          f'{len(outcomes) - placed} turned away')
+    print(f'stock {args.stock}, sold {sold}, remaining {remaining}, orders {orders}, orphaned orders {orphaned}')
+
+    problems = []
+    if remaining < 0 or sold + remaining != args.stock:
+        problems.append('stock was oversold or lost')
+    if orphaned:
+        problems.append('orders were left without items')
+    if orders != placed:
+        problems.append('order count does not match successful checkouts')
+    if problems:
+        sys.exit('FAILED: ' + '; '.join(problems))
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""Time /api/suggest lookups from the in-memory prefix index.
+
+Seeds a throwaway SQLite database, loads the suggestion index and looks up
+prefixes of one to six letters taken from real product names:
+
+    python benchmarks/suggest.py --products 20000 --lookups 5000
+
+Reports the index load time and memory, and lookup latency next to the FTS5
+prefix query the marketplace search runs. Then edits, adds and deletes
+products through the index and fails unless the results match a fresh
+load, or if the p99 lookup takes a millisecond or more. It also looks up
+prefixes while another thread adds and removes products, and fails if a
+lookup raises.
+
+Through /api/suggest it then checks that a product edit made by this process
+doesn't reload the index, and that a change made elsewhere is picked up by
+a reload on a background thread while the request that noticed it returns
+straight away.
+"""
+import argparse
+import random
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+from common import make_app, sign_in
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return statistics.median(samples), samples[int(len(samples) * 0.99)]
+
+
+def check_concurrent_writes(index, seconds=2):
+    # Lookups don't lock, so a product can be removed between a lookup
+    # finding its entries and reading its details
+    stop = threading.Event()
+
+    def churn():
+        product_id = 10 ** 9
+        while not stop.is_set():
+            product_id += 1
+            index.add(product_id, 'Zanzibar Cloves', 'Spices', 10)
+            index.remove(product_id)
+
+    writer = threading.Thread(target=churn)
+    # Switch threads as often as possible, so the writer lands inside lookups
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    writer.start()
+    lookups = 0
+    try:
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            index.search('zanz')
+            index.search('zanzibar clo')
+            lookups += 2
+    except Exception as e:
+        sys.exit(f'FAILED: a lookup raised {e!r} during concurrent writes')
+    finally:
+        stop.set()
+        writer.join()
+        sys.setswitchinterval(interval)
+    return lookups
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--lookups', type=int, default=5000)
+    parser.add_argument('--edits', type=int, default=500)
+    args = parser.parse_args()
+
+    app = make_app('suggest.db')
+    from sqlalchemy import column, delete, update
+    from app import bump_catalog_version, load_suggestions, search_expression, search_rank, seed_database, \
+        suggest_index
+    from models import db, Product, product_search
+    from suggest import SuggestIndex, words
+
+    rng = random.Random(42)
+    with app.app_context():
+        seed_database(50, 100, args.products, reviews=args.products * 2, carts=0, orders=0)
+        db.session.commit()
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        load_suggestions()
+        load_ms = (time.perf_counter() - started) * 1000
+        memory = tracemalloc.get_traced_memory()[0] / 1024 / 1024
+        tracemalloc.stop()
+        print(f'load: {load_ms:.0f} ms, {memory:.1f} MB for {suggest_index.stats()}')
+
+        names = [name for (name,) in db.session.query(Product.name)]
+        queries = []
+        for _ in range(args.lookups):
+            word = rng.choice(words(rng.choice(names)))
+            queries.append(word[:rng.randint(1, 6)])
+
+        def fts(query):
+            return db.session.query(Product.id).\
+                join(product_search, product_search.c.rowid == Product.id).\
+                filter(column('product_search').match(search_expression(query)), Product.quantity > 0).\
+                order_by(search_rank).limit(8).all()
+
+        results = {}
+        for label, lookup in (('prefix index', lambda query: suggest_index.search(query)), ('FTS5 query', fts)):
+            samples = []
+            for query in queries:
+                started = time.perf_counter()
+                lookup(query)
+                samples.append((time.perf_counter() - started) * 1000)
+            results[label] = percentiles(samples)
+            print(f'{label}: median {results[label][0]:.3f} ms, p99 {results[label][1]:.3f} ms')
+
+        # Incremental updates, then compare with loading from scratch
+        products = db.session.query(Product).order_by(Product.id).limit(args.edits * 2).all()
+        for product in products[:args.edits]:
+            product.name = f'{product.name} Deluxe'
+            product.quantity = rng.choice([0, 0, 5, 500])
+            suggest_index.add(product.id, product.name, product.category, product.quantity,
+                              product.rating.average if product.rating else 0)
+        removed = [product.id for product in products[args.edits:]]
+        for product_id in removed:
+            suggest_index.remove(product_id)
+        db.session.execute(delete(Product).where(Product.id.in_(removed)))
+        for n in range(args.edits):
+            product = Product(name=f'Heirloom Variety {n}', description='', price=1, quantity=n + 1,
+                              category='Vegetables', farmer_id=1)
+            db.session.add(product)
+            db.session.flush()
+            suggest_index.add(product.id, product.name, product.category, product.quantity)
+        db.session.commit()
+
+        incremental = suggest_index._get_current_object()
+        app.extensions['market']['suggest_index'] = SuggestIndex()
+        load_suggestions()
+        for query in set(queries) | {'deluxe', 'heirloom', 'heirloom var'}:
+            if incremental.search(query) != suggest_index.search(query):
+                sys.exit(f'FAILED: incremental index differs from a fresh load for {query!r}')
+
+        lookups = check_concurrent_writes(suggest_index._get_current_object())
+        print(f'{lookups} lookups during concurrent adds and removes')
+
+        # Check the catalog version on every request from here on
+        suggest_index.refresh_interval = 0
+        product = db.session.query(Product).filter(Product.quantity > 0).first()
+        product_id, farmer_id = product.id, product.farmer_id
+        loads = suggest_index.stats()['loads']
+
+    def suggest(query):
+        response = client.get(f'/api/suggest?q={query}')
+        if response.status_code != 200:
+            sys.exit(f'FAILED: /api/suggest returned {response.status_code}')
+        return {suggestion['id'] for suggestion in response.get_json()['suggestions']}
+
+    def wait_for_reloads():
+        deadline = time.monotonic() + 30
+        while suggest_index.stats()['reloading'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    client = app.test_client()
+    sign_in(client, farmer_id)
+    response = client.post(f'/edit_product/{product_id}', data={
+        'name': 'Quinceberry Jam', 'description': '', 'price': '3', 'quantity': '5', 'category': 'Pantry'})
+    if response.status_code != 302:
+        sys.exit(f'FAILED: editing a product returned {response.status_code}')
+    found = product_id in suggest('quinceberry')
+    with app.app_context():
+        wait_for_reloads()
+        if not found:
+            sys.exit('FAILED: the edited product is not suggested')
+        if suggest_index.stats()['loads'] != loads:
+            sys.exit("FAILED: this process's own edit reloaded the index")
+
+        # As if another worker renamed it
+        db.session.execute(update(Product).where(Product.id == product_id).values(name='Medlar Jam'))
+        bump_catalog_version()
+        db.session.commit()
+    started = time.perf_counter()
+    suggest('medlar')
+    noticed_ms = (time.perf_counter() - started) * 1000
+    with app.app_context():
+        wait_for_reloads()
+        if suggest_index.stats()['loads'] != loads + 1:
+            sys.exit("FAILED: another process's change did not reload the index")
+    if product_id not in suggest('medlar') or product_id in suggest('quinceberry'):
+        sys.exit('FAILED: the background reload did not pick up the rename')
+    print(f'request that started a background reload: {noticed_ms:.1f} ms (a full load took {load_ms:.0f} ms)')
+
+    if results['prefix index'][1] >= 1:
+        sys.exit(f'FAILED: p99 lookup took {results["prefix index"][1]:.3f} ms')
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Check that signed in requests stop querying the user table once cached.
+
+Runs against a throwaway SQLite database:
+
+    python benchmarks/user_cache.py --requests 200
+"""
+import argparse
+import re
+import sys
+import time
+
+from common import add_users, make_app, sign_in
+
+USER_TABLE = re.compile(r'\bFROM "?user"?\b', re.IGNORECASE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    app = make_app('user_cache.db')
+    from sqlalchemy import event
+    from app import load_user, user_cache
+    from models import db
+
+    with app.app_context():
+        customer_id = add_users('customer', 1)[0].id
+        db.session.commit()
+
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *rest: statements.append(statement))
+
+    client = app.test_client()
+    sign_in(client, customer_id)
+
+    def user_queries(path, method='get', **kwargs):
+        del statements[:]
+        response = getattr(client, method)(path, **kwargs)
+        if response.status_code >= 400:
+            sys.exit(f'FAILED: {method.upper()} {path} returned {response.status_code}')
+        return sum(1 for statement in statements if USER_TABLE.search(statement))
+
+    problems = []
+    if user_queries('/cart') != 1:
+        problems.append('the first request did not load the user')
+
+    started = time.perf_counter()
+    cached = sum(user_queries('/cart') for _ in range(args.requests))
+    elapsed = time.perf_counter() - started
+    if cached:
+        problems.append(f'{cached} user table queries on cache hits')
+
+    # Changing the profile has to drop the cached identity
+    user_queries('/profile', method='post', data={'email': 'new@example.com'})
+    if user_queries('/cart') != 1:
+        problems.append('the profile update did not invalidate the cached user')
+    with app.app_context():
+        if load_user(customer_id).email != 'new@example.com':
+            problems.append('the cached user still has the old email')
+
+    with app.app_context():
+        stats = user_cache.stats()
+    print(f'{args.requests} cached requests in {elapsed:.2f}s, {cached} user table queries')
+    print(f'user cache: {stats["hits"]} hits, {stats["misses"]} misses, size {stats["size"]}/{stats["maxsize"]}, '
+          f'ttl {stats["ttl"]}s')
+
+    if problems:
+        sys.exit('FAILED: ' + '; '.join(problems))
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
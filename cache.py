@@ -0,0 +1,67 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    # Small thread-safe cache: entries expire after `ttl` seconds and the least
+    # recently used entry is evicted once `maxsize` is reached.
+
+    def __init__(self, maxsize=128, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def get_or_load(self, key, loader):
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is not sentinel:
+            return value
+
+        # Load outside the lock so a slow query doesn't block other keys, and
+        # drop the result if the cache was invalidated while it was loading
+        generation = self._generation
+        value = loader()
+        with self._lock:
+            if generation == self._generation:
+                self._store(key, value)
+        return value
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries),
+                    'maxsize': self.maxsize, 'ttl': self.ttl}
+
+    def _store(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
@@ -0,0 +1,77 @@
+import os
+
+# Named database engine profiles, picked with the DB_PROFILE environment variable.
+# `pragmas` are applied to every new SQLite connection through a connect-event
+# hook; `engine_options` are passed straight to SQLAlchemy's create_engine.
+ENGINE_PROFILES = {
+    # SQLite's stock settings: rollback journal, writers block readers
+    'development': {
+        'pragmas': {},
+        'engine_options': {},
+    },
+    # WAL lets readers carry on while checkout and add_to_cart write, and the
+    # busy timeout makes writers queue for the lock instead of failing at once
+    'production': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 5000,       # milliseconds
+            'cache_size': -64000,       # negative means KiB, so 64 MB per connection
+            'mmap_size': 268435456,     # 256 MB
+            'temp_store': 'MEMORY',
+        },
+        'engine_options': {
+            'pool_size': 10,
+            'max_overflow': 20,
+            'pool_timeout': 30,
+            'pool_pre_ping': False,
+        },
+    },
+}
+
+
+def engine_profile(name=None):
+    name = name or os.environ.get('DB_PROFILE', 'development')
+    if name not in ENGINE_PROFILES:
+        raise ValueError(f'Unknown DB_PROFILE {name!r}, expected one of {", ".join(ENGINE_PROFILES)}')
+    return name, ENGINE_PROFILES[name]
+
+
+def load_settings():
+    # Flask config for create_app(), read from the environment when called.
+    # ASSET_DIR and MEDIA_FOLDER default to paths under the app's static and
+    # instance folders, so create_app() fills them in when they are None.
+    profile_name, profile = engine_profile()
+    return {
+        'SECRET_KEY': os.environ.get('SECRET_KEY', 'your-secret-key-here'),
+        'SQLALCHEMY_DATABASE_URI': os.environ.get('DATABASE_URL', 'sqlite:///farmers_market.db'),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'DB_PROFILE': profile_name,
+        'SQLALCHEMY_ENGINE_OPTIONS': profile['engine_options'],
+        'SQLITE_PRAGMAS': profile['pragmas'],
+        'PRODUCTS_PER_PAGE': int(os.environ.get('PRODUCTS_PER_PAGE', 24)),
+        'SUGGEST_REFRESH': int(os.environ.get('SUGGEST_REFRESH', 30)),
+        'SUGGEST_LIMIT': 8,
+        'QUERY_STATS_HEADER': os.environ.get('QUERY_STATS_HEADER') == '1',
+        'CATALOG_CACHE_TTL': int(os.environ.get('CATALOG_CACHE_TTL', 300)),
+        'EVENT_BROKER': os.environ.get('EVENT_BROKER', 'events:LocalBroker'),
+        'IMPORT_BATCH_SIZE': int(os.environ.get('IMPORT_BATCH_SIZE', 1000)),
+        'IMPORT_MAX_REPORTED_ERRORS': 200,
+        'ORDER_BATCH_LIMIT': 500,
+        'ORDER_ARCHIVE_DAYS': int(os.environ.get('ORDER_ARCHIVE_DAYS', 90)),
+        'ORDER_ARCHIVE_BATCH': int(os.environ.get('ORDER_ARCHIVE_BATCH', 500)),
+        'ORDER_HISTORY_PER_PAGE': 20,
+        'CART_BATCH_LIMIT': 100,
+        'USER_CACHE_SIZE': int(os.environ.get('USER_CACHE_SIZE', 4096)),
+        'USER_CACHE_TTL': int(os.environ.get('USER_CACHE_TTL', 60)),
+        'ASSET_DIR': None,
+        # Part of every catalog page ETag; create_app() falls back to the
+        # modification time of the code and templates when it is unset
+        'BUILD_ID': os.environ.get('BUILD_ID'),
+        'MEDIA_FOLDER': os.environ.get('MEDIA_FOLDER'),
+        'THUMBNAIL_WORKERS': int(os.environ.get('THUMBNAIL_WORKERS', 2)),
+        'PRODUCT_IMAGE_MAX_BYTES': 10 * 1024 * 1024,
+        # Shared by all worker processes; `serve` makes a temporary one when unset
+        'METRICS_DIR': os.environ.get('METRICS_DIR'),
+        'METRICS_TOKEN': os.environ.get('METRICS_TOKEN'),
+    }
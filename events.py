@@ -0,0 +1,74 @@
+import importlib
+import queue
+import threading
+from collections import defaultdict
+
+
+class Broker:
+    # Interface every pub/sub backend implements. Channels are plain strings;
+    # messages are JSON-serialisable dicts.
+
+    def publish(self, channel, event, data):
+        raise NotImplementedError
+
+    def subscribe(self, channel):
+        # Returns an object with get(timeout) -> message or None, and close()
+        raise NotImplementedError
+
+
+class LocalSubscription:
+    def __init__(self, broker, channel, maxsize):
+        self.broker = broker
+        self.channel = channel
+        self.queue = queue.Queue(maxsize=maxsize)
+
+    def get(self, timeout=None):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker._unsubscribe(self)
+
+
+class LocalBroker(Broker):
+    # Fans messages out to subscribers inside this process. Only clients
+    # connected to the same worker see each other's events.
+
+    def __init__(self, max_queue=100):
+        self.max_queue = max_queue
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def publish(self, channel, event, data):
+        message = {'event': event, 'data': data}
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait(message)
+            except queue.Full:
+                # A stalled client shouldn't hold up publishers; it will
+                # resync when it reconnects
+                pass
+
+    def subscribe(self, channel):
+        subscription = LocalSubscription(self, channel, self.max_queue)
+        with self._lock:
+            self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+
+def load_broker(spec):
+    # spec is 'module:ClassName', e.g. 'events:LocalBroker'
+    module_name, class_name = spec.split(':')
+    return getattr(importlib.import_module(module_name), class_name)()
@@ -0,0 +1,303 @@
+import glob
+import itertools
+import json
+import os
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+from flask import before_render_template, current_app, g, has_request_context, request, template_rendered
+
+from query_stats import on_statement
+
+# Upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _add(totals, key, values):
+    total = totals.setdefault(key, [0] * len(values))
+    for i, value in enumerate(values):
+        total[i] += value
+
+
+class _ShardOwner:
+    # Referenced only from its thread's threading.local, so it is freed when
+    # the thread exits
+    __slots__ = ('__weakref__',)
+
+
+def _retire_shard(registry, shard_id):
+    registry = registry()
+    if registry is not None:
+        registry._retire(shard_id)
+
+
+class MetricsRegistry:
+    # Counters and histograms in Prometheus text format. Each thread records
+    # into a dict only it writes to, so the request path takes no lock; a
+    # scrape adds the threads' dicts up. The server starts a thread per
+    # connection, so when a thread exits its dict is folded into one shared
+    # total and the number of dicts stays at the number of live threads. With
+    # a directory, every process also writes its totals there about once a
+    # second and a scrape adds up all the processes' files, so any worker can
+    # answer for the whole server.
+
+    def __init__(self, directory=None, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._families = {}
+        self._collectors = []
+        self._local = threading.local()
+        self._shards = {}
+        self._shard_ids = itertools.count()
+        self._retired = {}
+        self._shards_lock = threading.Lock()
+        self._flusher = None
+        self._dirty = False
+        # A forked worker starts from zero rather than repeating the parent's counts
+        registry = weakref.ref(self)
+        os.register_at_fork(after_in_child=lambda: registry() and registry()._reset())
+
+    def _reset(self):
+        # The new lock and dicts go in first: dropping the old local frees the
+        # parent's shard owners, and their finalizers take the lock
+        self._shards_lock = threading.Lock()
+        self._shards = {}
+        self._retired = {}
+        self._local = threading.local()
+        self._flusher = None
+
+    def histogram(self, name, help_text, labels, buckets):
+        self._families[name] = ('histogram', help_text, tuple(labels), tuple(buckets))
+
+    def counter(self, name, help_text, labels):
+        self._families[name] = ('counter', help_text, tuple(labels), None)
+
+    def gauge(self, name, help_text, labels):
+        self._families[name] = ('gauge', help_text, tuple(labels), None)
+
+    def add_collector(self, collect):
+        # collect() returns {(name, label values): value} for counters and
+        # gauges that are read from elsewhere when metrics are gathered
+        self._collectors.append(collect)
+
+    def observe(self, name, labels, value):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._add_shard()
+        key = (name, labels)
+        values = shard.get(key)
+        if values is None:
+            # Per bucket counts, then sum and count
+            values = shard[key] = [0] * (len(self._families[name][3]) + 2)
+        values[bisect_left(self._families[name][3], value)] += 1
+        values[-2] += value
+        values[-1] += 1
+        self._dirty = True
+        if self.directory and self._flusher is None:
+            self._start_flusher()
+
+    def _add_shard(self):
+        owner = _ShardOwner()
+        shard = {}
+        with self._shards_lock:
+            shard_id = next(self._shard_ids)
+            self._shards[shard_id] = shard
+        weakref.finalize(owner, _retire_shard, weakref.ref(self), shard_id)
+        self._local.owner, self._local.shard = owner, shard
+        return shard
+
+    def _retire(self, shard_id):
+        # The thread that owned the shard has exited, so nothing writes to it
+        with self._shards_lock:
+            shard = self._shards.pop(shard_id, None)
+            for key, values in (shard or {}).items():
+                _add(self._retired, key, values)
+
+    def shard_count(self):
+        return len(self._shards)
+
+    def _local_values(self):
+        totals = {}
+        # Under the lock, so a shard being retired isn't counted twice or missed
+        with self._shards_lock:
+            for key, values in self._retired.items():
+                _add(totals, key, values)
+            for shard in self._shards.values():
+                # list() copies the dict in one step, so the owning thread can keep writing
+                for key, values in list(shard.items()):
+                    _add(totals, key, values)
+        for collect in self._collectors:
+            for key, value in collect().items():
+                totals[key] = [value]
+        return totals
+
+    def _start_flusher(self):
+        with self._shards_lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self._dirty:
+                self._dirty = False
+                try:
+                    self.flush()
+                except OSError:
+                    # Try again with the next flush
+                    self._dirty = True
+
+    def flush(self):
+        path = os.path.join(self.directory, f'metrics-{os.getpid()}.json')
+        snapshot = {'pid': os.getpid(),
+                    'values': [[name, list(labels), values] for (name, labels), values in self._local_values().items()]}
+        with open(path + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(path + '.tmp', path)
+
+    def clear_directory(self):
+        # Called once before workers start, so counts from an earlier run
+        # aren't added to this one
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            os.remove(path)
+
+    def collect(self):
+        totals = self._local_values()
+        if not self.directory:
+            return totals
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            pid = snapshot['pid']
+            if pid == os.getpid():
+                continue
+            alive = _is_alive(pid)
+            for name, labels, values in snapshot['values']:
+                family = self._families.get(name)
+                # Counts from exited workers still add up; their gauges don't
+                if family is None or (family[0] == 'gauge' and not alive):
+                    continue
+                _add(totals, (name, tuple(labels)), values)
+        return totals
+
+    def render(self):
+        by_family = {}
+        for (name, labels), values in self.collect().items():
+            by_family.setdefault(name, []).append((labels, values))
+
+        lines = []
+        for name, (kind, help_text, label_names, buckets) in self._families.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, values in sorted(by_family.get(name, [])):
+                if kind != 'histogram':
+                    lines.append(f'{name}{_labels(label_names, labels)} {_number(values[0])}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), values):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    lines.append(f'{name}_bucket{_labels(label_names, labels, le)} {cumulative}')
+                lines.append(f'{name}_sum{_labels(label_names, labels)} {_number(values[-2])}')
+                lines.append(f'{name}_count{_labels(label_names, labels)} {values[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _endpoint():
+    if has_request_context():
+        return request.endpoint or 'unmatched'
+    return 'none'
+
+
+@on_statement
+def _record_statement(statement, parameters, elapsed):
+    # Timed by query_stats, which only calls this inside an app context
+    registry = current_app.extensions.get('metrics')
+    if registry is not None:
+        registry.observe('db_statement_duration_seconds', (_endpoint(),), elapsed)
+
+
+def register_caches(registry, caches):
+    # Hit and miss counts and current size for each named TTLCache
+    registry.counter('cache_hits_total', 'Cache lookups that found a fresh entry.', ['cache'])
+    registry.counter('cache_misses_total', 'Cache lookups that had to load the value.', ['cache'])
+    registry.gauge('cache_entries', 'Entries currently held by the cache.', ['cache'])
+
+    def collect():
+        samples = {}
+        for name, cache in caches.items():
+            stats = cache.stats()
+            samples['cache_hits_total', (name,)] = stats['hits']
+            samples['cache_misses_total', (name,)] = stats['misses']
+            samples['cache_entries', (name,)] = stats['size']
+        return samples
+
+    registry.add_collector(collect)
+
+
+def init_metrics(app):
+    registry = MetricsRegistry(app.config.get('METRICS_DIR'))
+    registry.histogram('http_request_duration_seconds', 'Time to build each response, by endpoint and status.',
+                       ['endpoint', 'method', 'status'], LATENCY_BUCKETS)
+    registry.histogram('db_statement_duration_seconds', 'Time per SQL statement, by the endpoint that issued it.',
+                       ['endpoint'], SQL_BUCKETS)
+    registry.histogram('template_render_duration_seconds', 'Time to render each Jinja template.',
+                       ['template'], LATENCY_BUCKETS)
+    app.extensions['metrics'] = registry
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            registry.observe('http_request_duration_seconds',
+                             (_endpoint(), request.method, str(response.status_code)),
+                             time.perf_counter() - started)
+        return response
+
+    def start_template_timer(sender, template, context, **extra):
+        g.setdefault('metrics_templates', []).append(time.perf_counter())
+
+    def record_template(sender, template, context, **extra):
+        registry.observe('template_render_duration_seconds', (template.name or 'string',),
+                         time.perf_counter() - g.metrics_templates.pop())
+
+    before_render_template.connect(start_template_timer, app, weak=False)
+    template_rendered.connect(record_template, app, weak=False)
+    return registry
@@ -0,0 +1,195 @@
+from datetime import datetime
+
+from flask_login import UserMixin
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import column, event, table, text
+
+# Bound to an app by create_app()
+db = SQLAlchemy()
+
+# Models - Define all models first without relationships that reference undefined classes
+class User(UserMixin, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), unique=True, nullable=False)
+    email = db.Column(db.String(120), unique=True, nullable=False)
+    password_hash = db.Column(db.String(120), nullable=False)
+    user_type = db.Column(db.String(20), nullable=False)  # 'farmer' or 'customer'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Product(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    description = db.Column(db.Text)
+    price = db.Column(db.Float, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False, index=True)
+    category = db.Column(db.String(50))
+    image_url = db.Column(db.String(200))
+    farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_product_created_at_id', 'created_at', 'id'),  # marketplace keyset order
+        db.Index('ix_product_category_created_at_id', 'category', 'created_at', 'id'),
+    )
+
+class Order(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    total_amount = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(20), default='pending')  # pending, accepted, shipped, delivered, cancelled
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_order_customer_id_created_at', 'customer_id', 'created_at'),
+        db.Index('ix_order_status_updated_at', 'status', 'updated_at'),  # archival candidates
+    )
+    
+    # Relationships
+    order_items = db.relationship('OrderItem', backref='order', lazy=True)
+
+class OrderItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # Add farmer_id to track who needs to fulfill
+    
+    __table_args__ = (
+        db.Index('ix_order_item_farmer_id_order_id', 'farmer_id', 'order_id'),
+    )
+
+class Review(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    rating = db.Column(db.Integer, nullable=False)
+    comment = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_review_product_id_customer_id', 'product_id', 'customer_id'),
+        db.Index('ix_review_customer_id', 'customer_id'),
+    )
+
+class Cart(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    
+    __table_args__ = (
+        db.Index('uq_cart_customer_id_product_id', 'customer_id', 'product_id', unique=True),
+    )
+
+class ProductRating(db.Model):
+    # Running rating totals per product, kept in step with the review table
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    stars_1 = db.Column(db.Integer, nullable=False, default=0)
+    stars_2 = db.Column(db.Integer, nullable=False, default=0)
+    stars_3 = db.Column(db.Integer, nullable=False, default=0)
+    stars_4 = db.Column(db.Integer, nullable=False, default=0)
+    stars_5 = db.Column(db.Integer, nullable=False, default=0)
+
+    @property
+    def average(self):
+        if not self.rating_count:
+            return 0
+        return round(self.rating_sum / self.rating_count, 1)
+
+    @property
+    def histogram(self):
+        return [self.stars_1, self.stars_2, self.stars_3, self.stars_4, self.stars_5]
+
+class SalesRollup(db.Model):
+    # Daily sales per farmer and product, kept up to date by checkout and by
+    # order cancellations so analytics never scan order_item
+    farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.Index('ix_sales_rollup_farmer_id_day', 'farmer_id', 'day'),
+    )
+
+class CatalogVersion(db.Model):
+    # Single row bumped by every write that changes what catalog pages show
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class CoPurchase(db.Model):
+    # How many orders contained both products, stored in both directions.
+    # Kept up to date by checkout; only read to re-rank recommendations.
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    other_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+
+class Recommendation(db.Model):
+    # Top co-purchased products per product, in rank order. The product page
+    # reads this with one primary key range scan.
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    recommended_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    order_count = db.Column(db.Integer, nullable=False)
+
+class ArchivedOrder(db.Model):
+    # Delivered and cancelled orders moved out of the order table by
+    # archive_orders(). Ids are kept, so links to an order stay meaningful.
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    total_amount = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_archived_order_customer_id_id', 'customer_id', 'id'),  # order history keyset order
+    )
+
+class ArchivedOrderItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('archived_order.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    farmer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_archived_order_item_farmer_id_order_id', 'farmer_id', 'order_id'),
+    )
+
+# Full-text index over the product catalog. It is an FTS5 virtual table, so it
+# lives outside the model metadata and is created alongside the other tables.
+product_search = table('product_search',
+                       column('rowid'), column('name'), column('description'), column('category'))
+
+@event.listens_for(db.metadata, 'after_create')
+def create_search_index(target, connection, **kw):
+    connection.execute(text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS product_search "
+        "USING fts5(name, description, category, tokenize='unicode61 remove_diacritics 2')"
+    ))
+
+# Now add relationships after all classes are defined
+# User relationships
+User.products = db.relationship('Product', backref='farmer', lazy=True, foreign_keys='Product.farmer_id')
+User.orders = db.relationship('Order', backref='customer', lazy=True, foreign_keys='Order.customer_id')
+User.written_reviews = db.relationship('Review', backref='author', lazy=True, foreign_keys='Review.customer_id')
+User.received_reviews = db.relationship('Review', backref='farmer_received', lazy=True, foreign_keys='Review.farmer_id')
+User.cart_items = db.relationship('Cart', backref='cart_owner', lazy=True, foreign_keys='Cart.customer_id')
+
+# Product relationships
+Product.order_items = db.relationship('OrderItem', backref='product', lazy=True)
+Product.reviews = db.relationship('Review', backref='product', lazy=True, foreign_keys='Review.product_id')  # Fixed this line
+Product.rating = db.relationship('ProductRating', uselist=False, lazy=True)
+
+# Cart relationships
+Cart.product = db.relationship('Product', backref='product_carts', lazy=True, foreign_keys='Cart.product_id')
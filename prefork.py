@@ -0,0 +1,135 @@
+import gc
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+logger = logging.getLogger(__name__)
+
+# A worker that dies sooner than this after starting is respawned after a
+# pause, so an app that can't start doesn't turn into a fork loop
+MIN_WORKER_LIFETIME = 1.0
+
+
+class RequestHandler(WSGIRequestHandler):
+    # No access log, as with most production servers; errors are still logged
+    def log_request(self, code='-', size='-'):
+        pass
+
+
+def parse_bind(bind):
+    host, _, port = bind.rpartition(':')
+    return host.strip('[]') or '127.0.0.1', int(port)
+
+
+def bind_socket(host, port, backlog=2048):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+class PreforkServer:
+    # Binds one listening socket and forks `workers` processes that all
+    # accept on it, each running a threaded werkzeug server. With preload the
+    # app is built once in the parent before forking, so workers start
+    # instantly and share its memory copy-on-write; without it every worker
+    # calls load_app() itself. after_fork(app) runs in each worker before it
+    # serves anything, to drop state (e.g. pooled connections) inherited from
+    # the parent.
+
+    def __init__(self, load_app, host='127.0.0.1', port=8000, workers=2, preload=True, after_fork=None):
+        self.load_app = load_app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.preload = preload
+        self.after_fork = after_fork
+        self.app = None
+        self.sock = None
+        self.children = {}
+        self.stopping = False
+
+    def run(self):
+        self.sock = bind_socket(self.host, self.port)
+        if self.preload:
+            self.app = self.load_app()
+        logger.info('Listening on http://%s:%s with %d workers (pid %d, %s)', self.host, self.port,
+                    self.workers, os.getpid(), 'preloaded' if self.preload else 'not preloaded')
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        # Move everything loaded so far out of the collector's reach, so
+        # collections in the workers don't write to (and un-share) those pages
+        gc.freeze()
+        try:
+            for _ in range(self.workers):
+                self._spawn()
+            self._supervise()
+        finally:
+            self.sock.close()
+        logger.info('Shut down')
+
+    def _spawn(self):
+        forked = time.monotonic()
+        pid = os.fork()
+        if pid:
+            self.children[pid] = forked
+            return
+        # In the worker: never return into the parent's code
+        status = 1
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self._serve(forked)
+            status = 0
+        except Exception:
+            logger.exception('Worker %d failed', os.getpid())
+        finally:
+            os._exit(status)
+
+    def _serve(self, forked):
+        app = self.app if self.preload else self.load_app()
+        if self.after_fork is not None:
+            self.after_fork(app)
+        server = make_server(self.host, self.port, app, threaded=True,
+                             request_handler=RequestHandler, fd=self.sock.fileno())
+        # shutdown() waits for serve_forever() to return, so it can't be
+        # called from the signal handler on the serving thread
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+        logger.info('Worker %d ready in %.0f ms', os.getpid(), (time.monotonic() - forked) * 1000)
+        server.serve_forever()
+        server.server_close()
+
+    def _supervise(self):
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            logger.warning('Worker %d exited with status %d, starting a new one', pid, os.waitstatus_to_exitcode(status))
+            if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+            if not self.stopping:
+                self._spawn()
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+def serve(load_app, bind='127.0.0.1:8000', workers=2, preload=True, after_fork=None):
+    host, port = parse_bind(bind)
+    PreforkServer(load_app, host, port, workers, preload, after_fork).run()
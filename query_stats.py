@@ -0,0 +1,85 @@
+import time
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+# Called with (statement, parameters, elapsed seconds) after every statement
+# that runs inside an app context; see on_statement()
+_statement_callbacks = []
+
+
+def query_budget(limit):
+    # Declare the most SQL statements a view may issue in one request
+    def decorator(view):
+        view.query_budget = limit
+        return view
+    return decorator
+
+
+def on_statement(callback):
+    # Register callback(statement, parameters, elapsed) for every statement
+    # timed here, so other instrumentation shares this one timer
+    _statement_callbacks.append(callback)
+    return callback
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context, which goes away with the statement even
+    # when it raises and after_cursor_execute never fires
+    context.query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context.query_started
+    if not has_app_context():
+        return
+    # Only statements issued while a request is being handled are counted
+    if 'query_stats' in g:
+        g.query_stats['count'] += 1
+        g.query_stats['time'] += elapsed
+    for callback in _statement_callbacks:
+        callback(statement, parameters, elapsed)
+
+
+def init_query_stats(app):
+    app.config.setdefault('QUERY_STATS_HEADER', False)
+    app.config.setdefault('QUERY_BUDGET_STRICT', False)
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = {'count': 0, 'time': 0.0}
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = g.pop('query_stats', None)
+        if stats is None:
+            return response
+
+        view = app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'query_budget', None)
+        elapsed_ms = stats['time'] * 1000
+
+        app.logger.info('%s %s %s: %d queries in %.1f ms', request.method, request.path,
+                        response.status_code, stats['count'], elapsed_ms)
+
+        if app.debug or app.config['QUERY_STATS_HEADER']:
+            response.headers['X-Query-Count'] = str(stats['count'])
+            response.headers['X-Query-Time-Ms'] = f'{elapsed_ms:.1f}'
+            if budget is not None:
+                response.headers['X-Query-Budget'] = str(budget)
+
+        if budget is not None and stats['count'] > budget:
+            message = f'{request.endpoint} issued {stats["count"]} queries, its budget is {budget}'
+            if app.config['QUERY_BUDGET_STRICT']:
+                raise QueryBudgetExceeded(message)
+            app.logger.warning(message)
+
+        return response
@@ -0,0 +1,36 @@
+import numpy as np
+from scipy import sparse
+
+
+def co_purchase_counts(order_ids, product_ids):
+    # Sparse product x product matrix counting the orders each pair of
+    # products appeared in together, built as X.T @ X from the binary order x
+    # product incidence matrix X. Returned as COO arrays (product, other,
+    # count) without the diagonal.
+    order_ids = np.asarray(order_ids, dtype=np.int64)
+    product_ids = np.asarray(product_ids, dtype=np.int64)
+    if not len(order_ids):
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+
+    orders, order_index = np.unique(order_ids, return_inverse=True)
+    products, product_index = np.unique(product_ids, return_inverse=True)
+    incidence = sparse.csr_matrix((np.ones(len(order_ids), dtype=np.int64), (order_index, product_index)),
+                                  shape=(len(orders), len(products)))
+    # The same product twice in one order still counts as one order
+    incidence.data[:] = 1
+    counts = (incidence.T @ incidence).tocoo()
+    off_diagonal = counts.row != counts.col
+    return (products[counts.row[off_diagonal]], products[counts.col[off_diagonal]],
+            counts.data[off_diagonal].astype(np.int64))
+
+
+def top_neighbours(product_ids, other_ids, counts, k):
+    # Keep the k highest counts per product, ties broken by the lower other
+    # id, and number them from 1. Returns (product, rank, other, count) arrays.
+    order = np.lexsort((other_ids, -counts, product_ids))
+    product_ids, other_ids, counts = product_ids[order], other_ids[order], counts[order]
+    starts = np.flatnonzero(np.r_[True, product_ids[1:] != product_ids[:-1]])
+    ranks = np.arange(len(product_ids)) - np.repeat(starts, np.diff(np.r_[starts, len(product_ids)])) + 1
+    keep = ranks <= k
+    return product_ids[keep], ranks[keep], other_ids[keep], counts[keep]
@@ -1,31 +1,93 @@
 document.addEventListener('DOMContentLoaded', function() {
-    // Add to cart functionality
-    const addToCartButtons = document.querySelectorAll('.add-to-cart');
-    
-    addToCartButtons.forEach(button => {
-        button.addEventListener('click', function() {
-            const productId = this.dataset.productId;
-            const quantityInput = this.parentElement.querySelector('.quantity-input');
-            const quantity = quantityInput ? quantityInput.value : 1;
-            
-            fetch(`/add_to_cart/${productId}`, {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/x-www-form-urlencoded',
-                },
-                body: `quantity=${quantity}`
-            })
-            .then(response => response.json())
-            .then(data => {
+    // Add to cart functionality (delegated so cards loaded later work too).
+    // Clicks are collected for a moment and sent to /api/cart as one batch,
+    // so a quick shopper costs one write instead of one per click.
+    const cartBadge = document.getElementById('cart-badge');
+    const pendingCart = new Map();
+    let cartTimer = null;
+    let cartInFlight = false;
+
+    document.addEventListener('click', function(event) {
+        const button = event.target.closest('.add-to-cart');
+        if (!button) {
+            return;
+        }
+
+        const productId = parseInt(button.dataset.productId, 10);
+        const quantityInput = button.parentElement.querySelector('.quantity-input');
+        const quantity = quantityInput ? parseInt(quantityInput.value, 10) || 1 : 1;
+
+        pendingCart.set(productId, (pendingCart.get(productId) || 0) + quantity);
+        clearTimeout(cartTimer);
+        cartTimer = setTimeout(flushCart, 400);
+    });
+
+    function flushCart() {
+        if (cartInFlight) {
+            // Send whatever piles up once the current request finishes
+            return;
+        }
+        const changes = Array.from(pendingCart, ([productId, quantity]) => (
+            { product_id: productId, op: 'increment', quantity: quantity }
+        ));
+        if (!changes.length) {
+            return;
+        }
+        pendingCart.clear();
+        cartInFlight = true;
+
+        fetch('/api/cart', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ changes: changes })
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (!data.success) {
                 alert(data.message);
-                if (data.success) {
-                    // Optional: Update cart counter
-                }
-            })
-            .catch(error => console.error('Error:', error));
+                return;
+            }
+            updateCartBadge(data.cart.units);
+            data.results.forEach(result => {
+                document.querySelectorAll(`.add-to-cart[data-product-id="${result.product_id}"]`).forEach(button => {
+                    if (result.success) {
+                        flashButton(button, 'Added ✓');
+                    }
+                });
+            });
+            const failed = data.results.filter(result => !result.success);
+            if (failed.length) {
+                alert(failed.map(result => result.message).join('\n'));
+            }
+        })
+        .catch(error => console.error('Error:', error))
+        .finally(() => {
+            cartInFlight = false;
+            if (pendingCart.size) {
+                flushCart();
+            }
         });
-    });
-    
+    }
+
+    function updateCartBadge(units) {
+        if (!cartBadge) {
+            return;
+        }
+        cartBadge.textContent = units;
+        cartBadge.classList.toggle('d-none', !units);
+    }
+
+    function flashButton(button, label) {
+        if (!button.dataset.label) {
+            button.dataset.label = button.textContent;
+        }
+        button.textContent = label;
+        clearTimeout(button.flashTimer);
+        button.flashTimer = setTimeout(() => { button.textContent = button.dataset.label; }, 1500);
+    }
+
     // Checkout functionality
     const checkoutButton = document.getElementById('checkout-btn');
     if (checkoutButton) {
@@ -46,4 +108,309 @@ document.addEventListener('DOMContentLoaded', function() {
             .catch(error => console.error('Error:', error));
         });
     }
+
+    // Marketplace: fetch later pages as the shopper scrolls
+    const productGrid = document.getElementById('product-grid');
+    const loadMore = document.getElementById('load-more');
+    if (productGrid && loadMore && 'IntersectionObserver' in window) {
+        let loading = false;
+
+        const observer = new IntersectionObserver(entries => {
+            if (entries[0].isIntersecting && !loading) {
+                loadNextPage();
+            }
+        }, { rootMargin: '400px' });
+
+        function loadNextPage() {
+            const params = new URLSearchParams({
+                cursor: loadMore.dataset.nextCursor,
+                category: loadMore.dataset.category,
+                search: loadMore.dataset.search
+            });
+            loading = true;
+
+            fetch(`/api/products?${params}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    throw new Error(data.message);
+                }
+                data.products.forEach(product => {
+                    productGrid.insertAdjacentHTML('beforeend', productCard(product));
+                });
+                if (data.next_cursor) {
+                    loadMore.dataset.nextCursor = data.next_cursor;
+                } else {
+                    observer.disconnect();
+                    loadMore.remove();
+                }
+            })
+            .catch(error => console.error('Error:', error))
+            .finally(() => { loading = false; });
+        }
+
+        function productCard(product) {
+            let stars = '';
+            for (let i = 0; i < 5; i++) {
+                stars += `<span class="${i < product.avg_rating ? 'text-warning' : 'text-muted'}">★</span>`;
+            }
+
+            let actions = '';
+            if (productGrid.dataset.canBuy === 'true') {
+                actions = `
+                        <div class="input-group mb-2">
+                            <input type="number" class="form-control quantity-input" value="1" min="1" max="${product.quantity}">
+                            <button class="btn btn-success add-to-cart" data-product-id="${product.id}">Add to Cart</button>
+                        </div>
+                        <a href="${product.url}" class="btn btn-outline-primary btn-sm">View Details</a>`;
+            }
+
+            const image = product.image
+                ? `<img src="${product.image.src}" srcset="${product.image.srcset}"
+                         sizes="(min-width: 1400px) 416px, (min-width: 768px) 30vw, 100vw"
+                         class="card-img-top product-image" alt="${escapeHtml(product.name).replace(/"/g, '&quot;')}" loading="lazy">`
+                : `<img src="${productGrid.dataset.placeholder}" class="card-img-top product-image" alt="" loading="lazy">`;
+
+            return `
+            <div class="col-md-4 mb-4">
+                <div class="card h-100">
+                    ${image}
+                    <div class="card-body">
+                        <h5 class="card-title">${escapeHtml(product.name)}</h5>
+                        <p class="card-text">${escapeHtml(product.description.slice(0, 100))}...</p>
+                        <p class="text-success fw-bold">$${product.price.toFixed(2)}</p>
+                        <p class="text-muted">In stock: ${product.quantity}</p>
+                        <div class="rating-display mb-2">
+                            <div class="stars">
+                                ${stars}
+                                <small class="text-muted ms-1">
+                                    (${product.avg_rating}) - ${product.review_count} reviews
+                                </small>
+                            </div>
+                        </div>
+                        <p class="text-info">Farmer: ${escapeHtml(product.farmer)}</p>
+                        ${actions}
+                    </div>
+                </div>
+            </div>`;
+        }
+
+        observer.observe(loadMore);
+    }
+
+    // Order pages: apply status changes and new orders pushed over /events
+    const orderStream = document.querySelector('[data-order-stream]');
+    if (orderStream && 'EventSource' in window) {
+        const statusClasses = {
+            pending: 'bg-warning',
+            accepted: 'bg-info',
+            shipped: 'bg-primary',
+            delivered: 'bg-success',
+            cancelled: 'bg-danger'
+        };
+        const progress = ['pending', 'accepted', 'shipped', 'delivered'];
+        const events = new EventSource('/events');
+
+        function statusBadge(status) {
+            const label = status.charAt(0).toUpperCase() + status.slice(1);
+            return `<span class="badge order-status ${statusClasses[status] || 'bg-secondary'}">${label}</span>`;
+        }
+
+        events.addEventListener('order_status', function(event) {
+            const order = JSON.parse(event.data);
+            document.querySelectorAll(`[data-order-id="${order.order_id}"]`).forEach(container => {
+                container.querySelectorAll('.order-status').forEach(badge => {
+                    Object.values(statusClasses).forEach(cls => badge.classList.remove(cls));
+                    badge.classList.remove('bg-secondary');
+                    badge.classList.add(statusClasses[order.status] || 'bg-secondary');
+                    badge.textContent = order.status.charAt(0).toUpperCase() + order.status.slice(1);
+                });
+                container.querySelectorAll('.order-updated').forEach(cell => {
+                    cell.textContent = order.updated_at;
+                });
+                container.querySelectorAll('.timeline-item[data-step]').forEach(item => {
+                    const step = item.dataset.step;
+                    const done = step === 'pending'
+                        ? order.status !== 'pending'
+                        : progress.indexOf(order.status) >= progress.indexOf(step);
+                    item.classList.toggle('completed', done);
+                });
+                const statusSelect = container.querySelector('select[name="status"]');
+                if (statusSelect) {
+                    statusSelect.value = order.status;
+                }
+            });
+        });
+
+        events.addEventListener('order_created', function(event) {
+            const order = JSON.parse(event.data);
+            const table = document.querySelector('[data-order-table]');
+            if (!table) {
+                // The page is showing its empty state, so render it properly
+                window.location.reload();
+                return;
+            }
+            if (table.querySelector(`[data-order-id="${order.order_id}"]`)) {
+                return;
+            }
+
+            const detailsUrl = table.dataset.orderTable === 'farmer'
+                ? `/farmer_order_details/${order.order_id}`
+                : `/order_details/${order.order_id}`;
+            const customerCell = table.dataset.orderTable === 'farmer'
+                ? `<td>${escapeHtml(order.customer)}</td>`
+                : '';
+            const dateCell = `<td>${order.created_at}</td>`;
+            const totalCell = `<td>$${order.total_amount.toFixed(2)}</td>`;
+
+            const selectCell = table.dataset.orderTable === 'farmer'
+                ? `<td><input type="checkbox" class="form-check-input order-select" value="${order.order_id}" aria-label="Select order #${order.order_id}"></td>`
+                : '';
+
+            table.insertAdjacentHTML('afterbegin', `
+                <tr data-order-id="${order.order_id}">
+                    ${selectCell}
+                    <td>#${order.order_id}</td>
+                    ${table.dataset.orderTable === 'farmer' ? customerCell + totalCell : dateCell + totalCell}
+                    <td>${statusBadge(order.status)}</td>
+                    ${table.dataset.orderTable === 'farmer' ? dateCell : ''}
+                    <td class="order-updated">${order.updated_at}</td>
+                    <td>
+                        <a href="${detailsUrl}" class="btn btn-sm btn-outline-primary">View Details</a>
+                    </td>
+                </tr>`);
+        });
+    }
+
+    // Marketplace: suggest products while the shopper types. Requests wait
+    // for a pause in typing, and an answer to an older query is dropped.
+    const searchInput = document.getElementById('search-input');
+    const suggestionList = document.getElementById('search-suggestions');
+    if (searchInput && suggestionList) {
+        let suggestTimer = null;
+        let suggestRequest = null;
+
+        function hideSuggestions() {
+            suggestionList.classList.add('d-none');
+            suggestionList.innerHTML = '';
+        }
+
+        searchInput.addEventListener('input', function() {
+            clearTimeout(suggestTimer);
+            const query = searchInput.value.trim();
+            if (!query) {
+                hideSuggestions();
+                return;
+            }
+            suggestTimer = setTimeout(() => fetchSuggestions(query), 150);
+        });
+
+        function fetchSuggestions(query) {
+            if (suggestRequest) {
+                suggestRequest.abort();
+            }
+            suggestRequest = new AbortController();
+
+            fetch(`/api/suggest?${new URLSearchParams({ q: query })}`, { signal: suggestRequest.signal })
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success || !data.suggestions.length) {
+                    hideSuggestions();
+                    return;
+                }
+                suggestionList.innerHTML = data.suggestions.map(suggestion => `
+                    <a href="${suggestion.url}" class="list-group-item list-group-item-action">
+                        ${escapeHtml(suggestion.name)}
+                        <small class="text-muted">${escapeHtml(suggestion.category || '')}</small>
+                    </a>`).join('');
+                suggestionList.classList.remove('d-none');
+            })
+            .catch(error => {
+                if (error.name !== 'AbortError') {
+                    console.error('Error:', error);
+                }
+            });
+        }
+
+        searchInput.addEventListener('keydown', function(event) {
+            if (event.key === 'Escape') {
+                hideSuggestions();
+            }
+        });
+        document.addEventListener('click', function(event) {
+            if (!suggestionList.contains(event.target) && event.target !== searchInput) {
+                hideSuggestions();
+            }
+        });
+    }
+
+    // Farmer orders: update the status of every selected order in one request
+    const batchApply = document.getElementById('batch-status-apply');
+    if (batchApply) {
+        const selectAll = document.getElementById('select-all-orders');
+        const selected = () => Array.from(document.querySelectorAll('.order-select:checked'));
+
+        function refreshSelection() {
+            const count = selected().length;
+            document.getElementById('batch-status-count').textContent = count;
+            batchApply.disabled = count === 0;
+        }
+
+        selectAll.addEventListener('change', function() {
+            document.querySelectorAll('.order-select').forEach(box => { box.checked = selectAll.checked; });
+            refreshSelection();
+        });
+        document.addEventListener('change', function(event) {
+            if (event.target.classList.contains('order-select')) {
+                refreshSelection();
+            }
+        });
+
+        batchApply.addEventListener('click', function() {
+            const status = document.getElementById('batch-status-select').value;
+            const orderIds = selected().map(box => parseInt(box.value, 10));
+            batchApply.disabled = true;
+
+            fetch('/api/orders/status', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({ order_ids: orderIds, status: status })
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    alert(data.message);
+                    return;
+                }
+                data.results.forEach(result => {
+                    const row = document.querySelector(`tr[data-order-id="${result.order_id}"]`);
+                    if (!row || !result.success) {
+                        return;
+                    }
+                    const badge = row.querySelector('.order-status');
+                    badge.outerHTML = `<span class="badge order-status ${
+                        {pending: 'bg-warning', accepted: 'bg-info', shipped: 'bg-primary',
+                         delivered: 'bg-success', cancelled: 'bg-danger'}[result.status]
+                    }">${result.status.charAt(0).toUpperCase() + result.status.slice(1)}</span>`;
+                    row.querySelector('.order-updated').textContent = result.updated_at;
+                    row.querySelector('.order-select').checked = false;
+                });
+                const failed = data.results.filter(result => !result.success).length;
+                if (failed) {
+                    alert(`${data.updated} orders updated, ${failed} could not be updated`);
+                }
+                selectAll.checked = false;
+            })
+            .catch(error => console.error('Error:', error))
+            .finally(refreshSelection);
+        });
+    }
+
+    function escapeHtml(text) {
+        const div = document.createElement('div');
+        div.textContent = text;
+        return div.innerHTML;
+    }
 });
\ No newline at end of file
@@ -0,0 +1,159 @@
+import heapq
+import re
+import sys
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+
+# A prefix matching more index entries than this has its top results
+# remembered until the index next changes, so one-letter lookups stay fast
+MEMO_THRESHOLD = 256
+
+
+def words(text):
+    # Lowercased words without diacritics, matching how the FTS5 index tokenizes
+    text = (text or '').lower()
+    if text.isascii():
+        return re.findall(r'\w+', text)
+    text = unicodedata.normalize('NFKD', text)
+    return re.findall(r'\w+', ''.join(c for c in text if not unicodedata.combining(c)))
+
+
+class SuggestIndex:
+    # In-memory type-ahead index over in-stock product names and categories.
+    # Every word is stored as a (word, product id) pair in one sorted list, so
+    # a prefix is answered by two bisects and a slice. Matches are ranked by
+    # rating, then by stock. Writers replace whole entries under a lock;
+    # lookups never lock, since the list is only changed one insert or delete
+    # at a time and a rebuild swaps in new objects. A product can still be
+    # removed between a lookup finding its entry and reading its details, so
+    # lookups read products with get() and skip the ones that are gone.
+    # Rebuilds after the first run on a background thread, so lookups keep
+    # answering meanwhile.
+
+    def __init__(self, refresh_interval=30):
+        self.refresh_interval = refresh_interval
+        self.version = None
+        self.loads = 0
+        self._checked_at = 0
+        self._entries = []
+        self._products = {}
+        self._memo = {}
+        self._lock = threading.Lock()
+        self._reloading = False
+
+    @property
+    def loaded(self):
+        return self.version is not None
+
+    def needs_check(self):
+        # Whether to compare the catalog version before answering
+        return not self.loaded or time.monotonic() - self._checked_at > self.refresh_interval
+
+    def mark_checked(self):
+        self._checked_at = time.monotonic()
+
+    def load(self, rows, version):
+        # rows are (id, name, category, quantity, rating) tuples
+        products = {}
+        entries = []
+        for product_id, name, category, quantity, rating in rows:
+            if quantity > 0:
+                products[product_id] = self._product(product_id, name, category, quantity, rating)
+                entries.extend((word, product_id) for word in products[product_id][3])
+        entries.sort()
+        with self._lock:
+            self._entries, self._products, self._memo = entries, products, {}
+            self.version = version
+            self.loads += 1
+            self.mark_checked()
+        return len(products)
+
+    def advance(self, version):
+        # The catalog moved to version through writes this process has
+        # already applied with add() and remove(). When the index was current
+        # before them it still is, and no reload is needed.
+        with self._lock:
+            if self.version is not None and self.version == version - 1:
+                self.version = version
+
+    def reload_in_background(self, load):
+        # Run load() on a thread unless a reload is already running
+        with self._lock:
+            if self._reloading:
+                return
+            self._reloading = True
+
+        def run():
+            try:
+                load()
+            finally:
+                self._reloading = False
+
+        threading.Thread(target=run, name='suggest-reload', daemon=True).start()
+
+    def add(self, product_id, name, category, quantity, rating=0):
+        # Add or replace one product; one that is out of stock is removed instead
+        if not self.loaded:
+            # Nothing to update, the first lookup will load everything
+            return
+        with self._lock:
+            self._discard(product_id)
+            if quantity <= 0:
+                return
+            product = self._products[product_id] = self._product(product_id, name, category, quantity, rating)
+            for word in product[3]:
+                entry = (word, product_id)
+                self._entries.insert(bisect_left(self._entries, entry), entry)
+
+    def remove(self, product_id):
+        if not self.loaded:
+            return
+        with self._lock:
+            self._discard(product_id)
+
+    def search(self, text, limit=8):
+        # Products with a word starting with every typed term. The longest
+        # term picks the candidates and the others filter them.
+        terms = words(text)
+        if not terms:
+            return []
+        terms.sort(key=len, reverse=True)
+        # Writers replace the memo rather than clear it, so a result worked
+        # out from the old entries can't be remembered past a change
+        entries, products, memo = self._entries, self._products, self._memo
+        lo = bisect_left(entries, (terms[0],))
+        hi = bisect_left(entries, (terms[0] + '\U0010ffff',))
+
+        memo_key = (terms[0], limit)
+        if len(terms) == 1 and hi - lo > MEMO_THRESHOLD and memo_key in memo:
+            return memo[memo_key]
+
+        candidates = [products.get(product_id) for product_id in {product_id for _, product_id in entries[lo:hi]}]
+        candidates = [product for product in candidates if product is not None]
+        if len(terms) > 1:
+            candidates = [product for product in candidates
+                          if all(any(word.startswith(term) for word in product[3]) for term in terms[1:])]
+        ranked = heapq.nsmallest(limit, candidates)
+        results = [{'id': product[0][3], 'name': product[1], 'category': product[2]} for product in ranked]
+        if len(terms) == 1 and hi - lo > MEMO_THRESHOLD:
+            memo[memo_key] = results
+        return results
+
+    def stats(self):
+        return {'version': self.version, 'loads': self.loads, 'reloading': self._reloading,
+                'products': len(self._products), 'entries': len(self._entries)}
+
+    def _product(self, product_id, name, category, quantity, rating):
+        # Sorts best first: highest rating, then most stock, then by name
+        keys = {sys.intern(word) for word in words(name) + words(category)}
+        return ((-rating, -quantity, name.lower(), product_id), name, category, tuple(keys))
+
+    def _discard(self, product_id):
+        product = self._products.pop(product_id, None)
+        if product is not None:
+            for word in product[3]:
+                index = bisect_left(self._entries, (word, product_id))
+                del self._entries[index]
+        self._memo = {}
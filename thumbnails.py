@@ -0,0 +1,125 @@
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Card, card@2x, detail and detail@2x widths. Every upload gets all of them,
+# so a thumbnail's name can be derived from the original's without a lookup.
+THUMBNAIL_WIDTHS = (320, 640, 800, 1600)
+UPLOAD_FORMATS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp'}
+
+
+def thumbnail_name(key, width):
+    return f'{os.path.splitext(key)[0]}-{width}w.webp'
+
+
+def save_original(folder, stream, max_bytes):
+    # Store an uploaded image under a name derived from its content and return
+    # that name. Only the header is parsed here; decoding and resizing happen
+    # in make_thumbnails().
+    if Image is None:
+        raise ValueError('Image uploads need Pillow installed')
+    data = stream.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise ValueError(f'Images can be at most {max_bytes // (1024 * 1024)} MB')
+    try:
+        image_format = Image.open(io.BytesIO(data)).format
+    except Exception:
+        raise ValueError('The file is not an image') from None
+    if image_format not in UPLOAD_FORMATS:
+        raise ValueError('Images must be JPEG, PNG or WebP')
+
+    key = f'products/{hashlib.sha256(data).hexdigest()[:20]}{UPLOAD_FORMATS[image_format]}'
+    path = os.path.join(folder, key)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+    return key
+
+
+def make_thumbnails(folder, key):
+    # Runs in a worker process. The smallest size is written last, so once it
+    # exists every other size does too.
+    with Image.open(os.path.join(folder, key)) as original:
+        image = ImageOps.exif_transpose(original)
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    for width in sorted(THUMBNAIL_WIDTHS, reverse=True):
+        if width < image.width:
+            resized = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        else:
+            # Never upscale; small originals are stored at their own size
+            resized = image
+        path = os.path.join(folder, thumbnail_name(key, width))
+        resized.save(path + '.tmp', format='WEBP', quality=80, method=6)
+        os.replace(path + '.tmp', path)
+
+
+def thumbnails_ready(folder, key):
+    return os.path.exists(os.path.join(folder, thumbnail_name(key, min(THUMBNAIL_WIDTHS))))
+
+
+class ThumbnailPool:
+    # Resizes uploads in worker processes so a request only has to store the
+    # original. The pool starts on first use, and an image that is already
+    # queued isn't queued again.
+
+    def __init__(self, folder, workers=2):
+        self.folder = folder
+        self.workers = workers
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, key):
+        with self._lock:
+            if key in self._pending:
+                return
+            if self._executor is None:
+                # spawn rather than fork: the parent holds database connections
+                # and server threads the workers shouldn't inherit
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            self._pending.add(key)
+            executor = self._executor
+        try:
+            future = executor.submit(make_thumbnails, self.folder, key)
+        except BrokenProcessPool:
+            self._discard(executor, key)
+            logger.error('Thumbnail pool is broken, %s will be retried on its next request', key)
+            return
+        future.add_done_callback(lambda future: self._finished(executor, key, future))
+
+    def _finished(self, executor, key, future):
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool):
+            # A worker died (e.g. killed for memory); start a fresh pool next time
+            self._discard(executor, key)
+        else:
+            with self._lock:
+                self._pending.discard(key)
+        if error is not None:
+            logger.error('Could not make thumbnails for %s: %s', key, error)
+
+    def _discard(self, executor, key):
+        with self._lock:
+            self._pending.discard(key)
+            if self._executor is executor:
+                self._executor = None
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)